@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pynini
+
+
+class DeterministicFst():
+    """
+    Runtime for a transducer that is deterministic on input, backed by dense state x input symbol tables of next states (-1 if no arc) and output symbols (0 for epsilon). Created by Fst.compile_deterministic()
+    """
+
+    def __init__(self, next_state, output, final, start, input_symbols,
+                 output_symbols):
+        self.next_state = next_state  # [state, input id] -> state
+        self.output = output  # [state, input id] -> output id
+        self.final = final  # [state] -> bool
+        self.start = start
+        self.input_symbols = input_symbols
+        self.output_symbols = output_symbols
+        # Flat python copies for scalar lookups in transduce_ids
+        self._width = next_state.shape[1]
+        self._next_state = next_state.ravel().tolist()
+        self._output = output.ravel().tolist()
+        self._final = final.tolist()
+
+    @classmethod
+    def compile(cls, fst):
+        """
+        Compile Fst into dense tables, raising ValueError if it has input epsilons or more than one arc per state and input label
+        """
+        arrays = fst.to_arrays()
+        src, ilabel = arrays['src'], arrays['ilabel']
+        if np.any(ilabel == 0):
+            q = src[np.flatnonzero(ilabel == 0)[0]]
+            raise ValueError(f'not deterministic: input epsilon arc '
+                             f'from state {fst.state_label(q)}')
+        n = fst.num_states()
+        width = max(fst.input_symbols().available_key(),
+                    int(ilabel.max()) + 1 if len(ilabel) else 1)
+        key = src.astype(np.int64) * width + ilabel
+        if len(np.unique(key)) != len(key):
+            key_sorted = np.sort(key)
+            k = key_sorted[np.flatnonzero(np.diff(key_sorted) == 0)[0]]
+            q, x = divmod(int(k), width)
+            raise ValueError(f'not deterministic: multiple arcs from state '
+                             f'{fst.state_label(q)} on input '
+                             f'{fst.input_label(x)}')
+
+        next_state = np.full((n, width), -1, dtype=np.int32)
+        output = np.zeros((n, width), dtype=np.int32)
+        next_state[src, ilabel] = arrays['nextstate']
+        output[src, ilabel] = arrays['olabel']
+        zero = float(pynini.Weight.zero(fst.weight_type()))
+        final = arrays['final'] != zero
+        return cls(next_state, output, final, fst.start(),
+                   fst.input_symbols(), fst.output_symbols())
+
+    def transduce_ids(self, x):
+        """
+        Output symbol ids for sequence x of input symbol ids, or None if x is not accepted
+        """
+        q = self.start
+        if q < 0:
+            return None
+        width = self._width
+        next_state = self._next_state
+        output = self._output
+        y = []
+        for x_i in x:
+            if x_i < 0 or x_i >= width:
+                return None
+            i = q * width + x_i
+            q = next_state[i]
+            if q < 0:
+                return None
+            if output[i] != 0:
+                y.append(output[i])
+        if not self._final[q]:
+            return None
+        return y
+
+    def transduce(self, x):
+        """
+        Transduce space-separated input x (list with unique output, or empty list if x is not accepted, as in Fst.transduce)
+        """
+        x = [self.input_symbols.find(sym) for sym in x.split()]
+        y = self.transduce_ids(x)
+        if y is None:
+            return []
+        return [' '.join([self.output_symbols.find(y_i) for y_i in y])]
+
+    def transduce_batch(self, X, lengths):
+        """
+        Vectorized transduction of padded batch X (sequences x lengths.max() array of input ids); returns boolean array of accepted sequences and array of output ids at each position (0 for epsilon or padding)
+        """
+        X = np.asarray(X, dtype=np.int64)
+        lengths = np.asarray(lengths)
+        m = X.shape[0]
+        Q = np.full(m, self.start, dtype=np.int64)
+        live = np.full(m, self.start >= 0)
+        Y = np.zeros(X.shape, dtype=np.int32)
+        width = self._width
+        for i in range(X.shape[1]):
+            active = live & (i < lengths)
+            x_i = X[:, i]
+            active &= (x_i >= 0) & (x_i < width)
+            idx = np.flatnonzero(active)
+            Q_i = self.next_state[Q[idx], x_i[idx]]
+            Y[idx, i] = self.output[Q[idx], x_i[idx]]
+            Q[idx] = Q_i
+            live[idx[Q_i < 0]] = False
+            # Invalid symbols in unpadded positions
+            live[np.flatnonzero(live & (i < lengths) & ~active)] = False
+        accepted = live.copy()
+        accepted[live] = self.final[Q[live]]
+        Y[~accepted] = 0
+        return accepted, Y
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from . import config
+
+
+class EncodedCorpus():
+    """
+    Corpus of space-separated strings encoded as symbol ids, packed in one flat int32 array with offsets (as in Arrow list arrays): string i is ids[offsets[i]:offsets[i+1]]. Unknown symbols are encoded as -1 (pynini.NO_SYMBOL)
+    """
+
+    def __init__(self, ids, offsets, symtable=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.symtable = symtable if symtable is not None else config.symtable
+
+    @classmethod
+    def encode(cls, corpus, symtable=None):
+        """
+        Encode iterable of space-separated strings with symtable (default: config.symtable), mapping each distinct symbol once
+        """
+        if symtable is None:
+            symtable = config.symtable
+        tokens = []
+        lengths = []
+        for x in corpus:
+            x = x.split()
+            tokens += x
+            lengths.append(len(x))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if len(tokens) == 0:
+            return cls(np.zeros(0, dtype=np.int32), offsets, symtable)
+        syms, inverse = np.unique(np.array(tokens), return_inverse=True)
+        sym_ids = np.array([symtable.find(sym) for sym in syms.tolist()],
+                           dtype=np.int32)
+        ids = sym_ids[inverse.reshape(-1)]
+        return cls(ids, offsets, symtable)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """ Ids of string i (view into flat array) """
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def decode(self, i=None):
+        """
+        Space-separated string i, or list of all strings if i is None (unknown symbols decoded as config.unk)
+        """
+        syms = {}
+        for sym_id, sym in self.symtable:
+            syms[sym_id] = sym
+        if i is not None:
+            return ' '.join([syms.get(x, config.unk) for x in self[i].tolist()])
+        tokens = [syms.get(x, config.unk) for x in self.ids.tolist()]
+        offsets = self.offsets.tolist()
+        return [
+            ' '.join(tokens[offsets[i]:offsets[i + 1]])
+            for i in range(len(self))
+        ]
+
+    def padded(self, pad=0):
+        """
+        Strings as (strings x max length) array padded with pad, and lengths (cf. DeterministicFst.transduce_batch)
+        """
+        lengths = self.lengths()
+        width = int(lengths.max()) if len(lengths) else 0
+        X = np.full((len(self), width), pad, dtype=np.int32)
+        rows = np.repeat(np.arange(len(self)), lengths)
+        cols = np.arange(len(self.ids)) - np.repeat(self.offsets[:-1], lengths)
+        X[rows, cols] = self.ids
+        return X, lengths
+
+    # Saving and loading
+
+    def save(self, prefix):
+        """ Save as prefix.ids.npy and prefix.offsets.npy """
+        np.save(f'{prefix}.ids.npy', self.ids)
+        np.save(f'{prefix}.offsets.npy', self.offsets)
+
+    @classmethod
+    def load(cls, prefix, symtable=None, mmap_mode='r'):
+        """ Load arrays saved by save(), memory-mapped by default """
+        ids = np.load(f'{prefix}.ids.npy', mmap_mode=mmap_mode)
+        offsets = np.load(f'{prefix}.offsets.npy', mmap_mode=mmap_mode)
+        return cls(ids, offsets, symtable)
@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import itertools
+import os
+import struct
 import sys
+import time
+from array import array
+from collections import OrderedDict
+from concurrent import futures
+import numpy as np
 import pynini
 from . import config
+from .compiled_fst import DeterministicFst
 
 
 class Fst(pynini.Fst):
@@ -28,6 +37,10 @@ class Fst(pynini.Fst):
         self._state2label = {}  # State id -> label
         self._label2state = {}  # Label -> state id
         self.sigma = {}  # State output function
+        self._transduce_cache = None  # Input -> outputs (LRU, optional)
+        self._transduce_cache_size = 0
+        self._transduce_cache_hits = 0
+        self._transduce_cache_misses = 0
 
     # States
 
@@ -38,6 +51,7 @@ class Fst(pynini.Fst):
             if state_label in self._label2state:
                 return self._label2state[state_label]
         # Create new state
+        self._invalidate()
         state = super().add_state()
         # Self-labeling by default
         if state_label is None:
@@ -50,6 +64,7 @@ class Fst(pynini.Fst):
     def set_start(self, state):
         if not isinstance(state, int):
             state = self.state_index(state)
+        self._invalidate()
         return super().set_start(state)
 
     def is_start(self, state):
@@ -62,6 +77,7 @@ class Fst(pynini.Fst):
             state = self.state_index(state)
         if weight is None:
             weight = pynini.Weight.one(self.weight_type())
+        self._invalidate()
         return super().set_final(state, weight)
 
     def finals(self):
@@ -103,17 +119,81 @@ class Fst(pynini.Fst):
         if not isinstance(dest, int):
             dest = self.state_index(dest)
         arc = pynini.Arc(ilabel, olabel, weight, dest)
+        self._invalidate()
         return super().add_arc(src, arc)
 
+    def add_arcs(self,
+                 arcs=None,
+                 src=None,
+                 ilabel=None,
+                 olabel=None,
+                 weight=None,
+                 dest=None):
+        """
+        Add arcs in bulk, given either as an iterable of (src, ilabel, olabel, weight, dest) records or as parallel sequences / arrays src, ilabel, [olabel, weight,] dest. Attributes are interpreted as in add_arc, but each distinct state label, symbol, and weight is resolved only once
+        """
+        if arcs is None:
+            n = len(src)
+            if olabel is None:
+                olabel = ilabel
+            if weight is None:
+                weight = [None] * n
+            arcs = zip(*[_tolist(x) for x in (src, ilabel, olabel, weight, dest)])
+
+        self._invalidate()
+        isymbols = self.mutable_input_symbols()
+        osymbols = self.mutable_output_symbols()
+        state_ids = {}  # State label -> id
+        isym_ids = {}  # Input symbol -> id
+        osym_ids = {}  # Output symbol -> id
+        weights = {None: pynini.Weight.one(self.weight_type())}
+        arc = pynini.Arc(0, 0, weights[None], 0)  # Reused; copied on add
+        arc_weight = weights[None]
+        add_arc = super().add_arc
+        for (q, x, y, w, r) in arcs:
+            if not isinstance(q, int):
+                if q not in state_ids:
+                    state_ids[q] = self.state_index(q)
+                q = state_ids[q]
+            if y is None:
+                y = x
+            if not isinstance(x, int):
+                if x not in isym_ids:
+                    isym_ids[x] = isymbols.add_symbol(x)
+                x = isym_ids[x]
+            if not isinstance(y, int):
+                if y not in osym_ids:
+                    osym_ids[y] = osymbols.add_symbol(y)
+                y = osym_ids[y]
+            if not isinstance(r, int):
+                if r not in state_ids:
+                    state_ids[r] = self.state_index(r)
+                r = state_ids[r]
+            if not isinstance(w, pynini.Weight):
+                if w not in weights:
+                    weights[w] = pynini.Weight(self.weight_type(), w)
+                w = weights[w]
+            arc.ilabel = x
+            arc.olabel = y
+            if w is not arc_weight:  # Setting weight is relatively slow
+                arc.weight = arc_weight = w
+            arc.nextstate = r
+            add_arc(q, arc)
+        return self
+
     def arcs(self, src):
         if not isinstance(src, int):
             src = self.state_index(src)
         return super().arcs(src)
 
     def mutable_arcs(self, src):
+        """
+        Mutable iterator over arcs of state src; arcs written with set_value() clear cached results
+        """
         if not isinstance(src, int):
             src = self.state_index(src)
-        return super().mutable_arcs(src)
+        self._invalidate()
+        return _MutableArcIterator(super().mutable_arcs(src), self)
 
     def num_arcs(self):
         """
@@ -131,7 +211,7 @@ class Fst(pynini.Fst):
         return self.output_symbols().find(sym_id)
 
     def map_weights(self, map_type='identity'):
-        if map_type == 'idenity':
+        if map_type == 'identity':
             return self
         fst = pynini.arcmap(self, map_type=map_type)
         return self.from_pynini(fst)
@@ -140,93 +220,343 @@ class Fst(pynini.Fst):
 
     def transduce(self, x):
         """
-        Transduce space-separated input x
+        Transduce space-separated input x (cached if set_transduce_cache has been called)
         """
+        if self._transduce_cache is not None:
+            Y = self._transduce_cache_get(x)
+            if Y is None:
+                Y = self._transduce(x)
+                self._transduce_cache_put(x, Y)
+            return list(Y)
+        return self._transduce(x)
+
+    def _transduce(self, x):
         isymbols = self.input_symbols()
         osymbols = self.output_symbols()
         try:
-            fst_in = pynini.accep(x, token_type=isymbols)
+            fst_in = pynini.accep(x,
+                                  token_type=isymbols,
+                                  arc_type=self.arc_type())
         except:
             return []
-        fst_out = fst_in @ self
+        fst_in.arcsort(sort_type='olabel')
+        fst_out = fst_in @ self._native()
         strpath_iter = fst_out.paths(
             input_token_type=isymbols, output_token_type=osymbols)
         Y = [y for y in strpath_iter.ostrings()]
         return Y
 
-    def istrings(self):
+    def transduce_nbest(self, x, k=1):
         """
-        Input strings of paths through this machine, assumed acyclic
+        The k best outputs for space-separated input x as (output, weight) pairs in order of weight, where the weight of an output combines all of its paths (minimum for tropical, sum for log), by n-shortest paths over the output lattice; empty list if x is not accepted
         """
         isymbols = self.input_symbols()
-        strpath_iter = fst.paths(input_token_type=isymbols)
-        X = [x for x in strpath_iter.istrings()]
-        return X
+        osymbols = self.output_symbols()
+        try:
+            fst_in = pynini.accep(x,
+                                  token_type=isymbols,
+                                  arc_type=self.arc_type())
+        except:
+            return []
+        fst_in.arcsort(sort_type='olabel')
+        M = fst_in @ self._native()
+        M.project('output')
+        M.rmepsilon()
+        if M.arc_type() == 'log':
+            # One path per output, with summed weight
+            M = pynini.arcmap(pynini.determinize(M), map_type='to_std')
+        elif M.arc_type() != 'standard':
+            raise ValueError(f'unsupported arc type {M.arc_type()}')
+        return _nshortest(M, k, True, osymbols)
+
+    def transduce_ids(self, x):
+        """
+        Transduce sequence or numpy array x of input symbol ids, returning list of output id sequences (epsilons removed); the input acceptor is built directly from ids, without tokenization
+        """
+        x = _tolist(x)
+        one = pynini.Weight.one(self.weight_type())
+        fst_in = pynini.Fst(self.arc_type())
+        fst_in.add_states(len(x) + 1)
+        fst_in.set_start(0)
+        fst_in.set_final(len(x))
+        arc = pynini.Arc(0, 0, one, 0)  # Reused; copied on add
+        for i, x_i in enumerate(x):
+            arc.ilabel = arc.olabel = x_i
+            arc.nextstate = i + 1
+            fst_in.add_arc(i, arc)
+        fst_in.arcsort(sort_type='olabel')
+        fst_out = pynini.compose(fst_in, self._native())
+        Y = []
+        strpath_iter = fst_out.paths()
+        while not strpath_iter.done():
+            Y.append([y for y in strpath_iter.olabels() if y != 0])
+            strpath_iter.next()
+        return Y
 
-    def ostrings(self):
+    def transduce_many(self, X):
         """
-        Output strings of paths through this machine, assumed acyclic
+        Transduce each space-separated input in X, composing this machine once with a prefix-trie over all of the inputs; returns list of outputs for each input
+        The trie is a transducer that reads each input on its output side and emits (on its input side) only a final marker identifying the input, so that paths through the composition can be split by input
+        Inputs found in the transduce cache (if any) are not added to the trie
         """
+        if self._transduce_cache is not None:
+            Y = [self._transduce_cache_get(x) for x in X]
+            X_miss = list(dict.fromkeys(
+                [x for (x, y) in zip(X, Y) if y is None]))
+            if len(X_miss) != 0:
+                Y_miss = dict(zip(X_miss, self._transduce_many(X_miss)))
+                for x, y in Y_miss.items():
+                    self._transduce_cache_put(x, y)
+            Y = [
+                list(y) if y is not None else list(Y_miss[x])
+                for (x, y) in zip(X, Y)
+            ]
+            return Y
+        return self._transduce_many(X)
+
+    def _transduce_many(self, X):
+        isymbols = self.input_symbols()
         osymbols = self.output_symbols()
-        strpath_iter = fst.paths(output_token_type=osymbols)
-        Y = [y for y in strpath_iter.ostrings()]
+        one = pynini.Weight.one(self.weight_type())
+        trie = pynini.Fst(self.arc_type())
+        root = trie.add_state()
+        trie.set_start(root)
+        qf = trie.add_state()
+        trie.set_final(qf)
+        nodes = {}  # (node, symbol id) -> node
+        markers = {}  # Input -> marker
+        Y = [[] for x in X]
+        for x in X:
+            if x in markers:
+                continue
+            x_ids = [isymbols.find(sym) for sym in x.split()]
+            if pynini.NO_SYMBOL in x_ids:  # Unknown symbols
+                markers[x] = None
+                continue
+            q = root
+            for sym_id in x_ids:
+                if (q, sym_id) not in nodes:
+                    r = trie.add_state()
+                    trie.add_arc(q, pynini.Arc(0, sym_id, one, r))
+                    nodes[(q, sym_id)] = r
+                q = nodes[(q, sym_id)]
+            markers[x] = len(markers) + 1
+            trie.add_arc(q, pynini.Arc(markers[x], 0, one, qf))
+
+        # Split output strings by marker
+        Y_marker = {}
+        trie.arcsort(sort_type='olabel')
+        fst_out = pynini.compose(trie, self._native())
+        strpath_iter = fst_out.paths()
+        while not strpath_iter.done():
+            marker = [x for x in strpath_iter.ilabels() if x != 0][0]
+            y = [osymbols.find(y) for y in strpath_iter.olabels() if y != 0]
+            if marker not in Y_marker:
+                Y_marker[marker] = []
+            Y_marker[marker].append(' '.join(y))
+            strpath_iter.next()
+
+        for i, x in enumerate(X):
+            if markers[x] is not None:
+                Y[i] = list(Y_marker.get(markers[x], []))
         return Y
 
-    def connect(self):
+    def transduce_parallel(self, X, workers=None, chunk_size=1000,
+                           ordered=True):
+        """
+        Transduce space-separated inputs from iterable X in worker processes, generating the list of outputs for each input in order (or (index, outputs) pairs as they finish if ordered=False). The machine is sent to each worker once, as pynini binary plus state labels; inputs are read and sent in chunks of chunk_size, with at most two chunks per worker pending
+        """
+        if workers is None:
+            workers = os.cpu_count()
+        state = (pynini.Fst.write_to_string(self), self._state2label)
+        X = iter(X)
+        chunks = ((i, list(itertools.islice(X, chunk_size)))
+                  for i in itertools.count(0, chunk_size))
+        chunks = itertools.takewhile(lambda chunk: len(chunk[1]) != 0, chunks)
+        with futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_worker,
+                initargs=state) as executor:
+            pending = []
+            for chunk in itertools.islice(chunks, 2 * workers):
+                pending.append(executor.submit(_transduce_chunk, chunk))
+            while len(pending) != 0:
+                if ordered:
+                    done = [pending.pop(0)]
+                    i, Y = done[0].result()
+                    yield from Y
+                else:
+                    done, _ = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                    for job in done:
+                        pending.remove(job)
+                        i, Y = job.result()
+                        yield from enumerate(Y, start=i)
+                for chunk in itertools.islice(chunks, len(done)):
+                    pending.append(executor.submit(_transduce_chunk, chunk))
+
+    # Transduction cache
+
+    def set_transduce_cache(self, maxsize=1024):
+        """
+        Enable bounded LRU cache of transduce() results with at most maxsize inputs (None or 0: disable). The cache is cleared by the mutating methods of Fst (including writes through mutable_arcs iterators), but not by in-place operations inherited from pynini (e.g., invert, project, closure, relabel_pairs): call set_transduce_cache again after these
+        """
+        if not maxsize:
+            self._transduce_cache = None
+            self._transduce_cache_size = 0
+        else:
+            self._transduce_cache = OrderedDict()
+            self._transduce_cache_size = maxsize
+        self._transduce_cache_hits = 0
+        self._transduce_cache_misses = 0
+
+    def transduce_cache_info(self):
+        """ Hits, misses, maximum and current size of transduce cache """
+        return {
+            'hits': self._transduce_cache_hits,
+            'misses': self._transduce_cache_misses,
+            'maxsize': self._transduce_cache_size,
+            'currsize': len(self._transduce_cache or ())
+        }
+
+    def _transduce_cache_get(self, x):
+        cache = self._transduce_cache
+        if x in cache:
+            cache.move_to_end(x)
+            self._transduce_cache_hits += 1
+            return cache[x]
+        self._transduce_cache_misses += 1
+        return None
+
+    def _transduce_cache_put(self, x, Y):
+        cache = self._transduce_cache
+        cache[x] = list(Y)
+        if len(cache) > self._transduce_cache_size:
+            cache.popitem(last=False)
+
+    def _invalidate(self):
+        """ Clear results cached for this machine (before mutation) """
+        if self._transduce_cache:
+            self._transduce_cache.clear()
+
+    def _native(self):
+        """
+        This machine as pynini Fst without labels, for composition (which otherwise calls copy(), a deep copy with labels); copy-on-write in constant time, so never out of date
+        """
+        return pynini.Fst.copy(self)
+
+    def compile_deterministic(self):
+        """
+        Compile machine that is deterministic on input (no input epsilons, at most one arc per state and input label) into a DeterministicFst, which transduces in time linear in the input without composition
+        """
+        return DeterministicFst.compile(self)
+
+    def istrings(self, max_len=10, limit=None, unique=True, order='length'):
         """
-        Remove states and arcs not on successful paths [nondestructive]
+        Generate input strings of paths through this machine with at most max_len symbols (epsilons excluded), also if cyclic. Up to limit strings, each only once if unique (otherwise once per path), in order of length (order='length') or of path weight (order='weight', by n-shortest paths; requires limit)
         """
-        accessible = self.accessible(forward=True)
-        coaccessible = self.accessible(forward=False)
-        live_states = accessible & coaccessible
-        dead_states = filter(lambda q: q not in live_states, self.states())
-        dead_states = list(dead_states)
-        fst = self.delete_states(dead_states, connect=False)
+        return _path_strings(self, 'input', max_len, limit, unique, order)
+
+    def ostrings(self, max_len=10, limit=None, unique=True, order='length'):
+        """
+        Generate output strings of paths through this machine, as in istrings()
+        """
+        return _path_strings(self, 'output', max_len, limit, unique, order)
+
+    def connect(self, inplace=False):
+        """
+        Remove states and arcs not on successful paths [nondestructive, or destructive if inplace=True]
+        """
+        offsets, nextstate = self._adjacency()
+        accessible = self._accessible(offsets, nextstate, forward=True)
+        coaccessible = self._accessible(offsets, nextstate, forward=False)
+        live = accessible & coaccessible
+        if inplace:
+            if live.all():
+                return self
+            dead_states = set(np.flatnonzero(~live).tolist())
+            return self._delete_states_inplace(dead_states, connect=False)
+        if self.weight_type() not in ('tropical', 'log'):
+            dead_states = set(np.flatnonzero(~live).tolist())
+            return self.delete_states(dead_states, connect=False)
+
+        # Renumber live states and keep arcs between them
+        arrays = self.to_arrays()
+        state_map = np.cumsum(live) - 1
+        src, dest = arrays['src'], arrays['nextstate']
+        keep = live[src] & live[dest]
+        q0 = self.start()
+        arrays = {
+            'src': state_map[src[keep]],
+            'ilabel': arrays['ilabel'][keep],
+            'olabel': arrays['olabel'][keep],
+            'weight': arrays['weight'][keep],
+            'nextstate': state_map[dest[keep]],
+            'final': arrays['final'][live],
+            'start': state_map[q0] if (q0 >= 0 and live[q0]) else -1
+        }
+        fst = self.from_arrays(arrays)
+        fst._state2label = {}
+        fst._label2state = {}
+        for q_new, q in enumerate(np.flatnonzero(live).tolist()):
+            q_label = self._state2label[q]
+            fst._state2label[q_new] = q_label
+            fst._label2state[q_label] = q_new
         return fst
 
     def accessible(self, forward=True):
         """
         States accessible from initial state -or- coaccessible from final states
         """
+        offsets, nextstate = self._adjacency()
+        Q = self._accessible(offsets, nextstate, forward)
+        return set(np.flatnonzero(Q).tolist())
+
+    def _adjacency(self):
+        """
+        Adjacency of states in CSR format: the destinations of arcs from state q are nextstate[offsets[q]:offsets[q+1]]
+        """
+        if self.weight_type() in ('tropical', 'log'):
+            arrays = self.to_arrays()
+            return arrays['offsets'], arrays['nextstate']
+        n = self.num_states()
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        nextstate = []
+        for q in range(n):
+            nextstate += [t.nextstate for t in self.arcs(q)]
+            offsets[q + 1] = len(nextstate)
+        return offsets, np.array(nextstate, dtype=np.int32)
+
+    def _accessible(self, offsets, nextstate, forward=True):
+        """
+        Boolean mask of states accessible from initial state -or- coaccessible from final states, by breadth-first search with numpy frontiers
+        """
+        n = len(offsets) - 1
         if forward:
-            # Initial state and forward transitions
-            Q = set([self.start()])
-            T = {}
-            for src in self.states():
-                T[src] = set()
-                for t in self.arcs(src):
-                    dest = t.nextstate
-                    T[src].add(dest)
+            q0 = self.start()
+            Q = np.array([q0] if q0 >= 0 else [], dtype=np.int64)
         else:
-            # Final states and backward transitions
-            Q = set([q for q in self.states() if self.is_final(q)])
-            T = {}
-            for src in self.states():
-                for t in self.arcs(src):
-                    dest = t.nextstate
-                    if dest not in T:
-                        T[dest] = set()
-                    T[dest].add(src)
-
-        # Find (co)accessible states
-        Q_old = set()
-        Q_new = set(Q)
-        while len(Q_new) != 0:
-            Q_old, Q_new = Q_new, Q_old
-            Q_new.clear()
-            for src in filter(lambda src: src in T, Q_old):
-                for dest in filter(lambda dest: dest not in Q, T[src]):
-                    Q.add(dest)
-                    Q_new.add(dest)
-        return Q
-
-    def delete_states(self, dead_states, connect=True):
-        """
-        Remove states while preserving labels [nondestructive]
+            Q = np.array(sorted(self.finals()), dtype=np.int64)
+            # Reverse adjacency
+            narcs = np.diff(offsets)
+            src = np.repeat(np.arange(n), narcs)
+            order = np.argsort(nextstate, kind='stable')
+            offsets = np.zeros(n + 1, dtype=np.int64)
+            np.cumsum(np.bincount(nextstate, minlength=n), out=offsets[1:])
+            nextstate = src[order]
+        return _reachable(offsets, nextstate, Q)
+
+    def delete_states(self, dead_states, connect=True, inplace=False):
         """
+        Remove states while preserving labels [nondestructive, or destructive if inplace=True]
+        """
+        dead_states = set(dead_states)
+        if inplace:
+            return self._delete_states_inplace(dead_states, connect)
 
         # Preserve input and output symbols
-        fst = Fst(self.input_symbols(), self.output_symbols())
+        fst = Fst(self.input_symbols(), self.output_symbols(),
+                  self.arc_type())
 
         # Reindex live states, copying labels
         state_map = {}
@@ -248,38 +578,52 @@ class Fst(pynini.Fst):
                 fst.add_arc(src, t.ilabel, t.olabel, t.weight, dest)
 
         if connect:
-            fst.connect()
+            fst = fst.connect()
         return fst
 
+    def _delete_states_inplace(self, dead_states, connect=True):
+        """
+        Remove states with pynini, which renumbers surviving states in their original order, and remap labels accordingly [destructive]
+        """
+        self._invalidate()
+        live_states = [q for q in self.states() if q not in dead_states]
+        super().delete_states(sorted(dead_states))
+        state2label = {}
+        for q_new, q in enumerate(live_states):
+            state2label[q_new] = self._state2label[q]
+        self._state2label = state2label
+        self._label2state = {label: q for q, label in state2label.items()}
+        if connect:
+            self.connect(inplace=True)
+        return self
+
     def delete_arcs(self, dead_arcs):
         """
         Delete arcs [destructive]
         Implemented by deleting all arcs from relevant states then adding back all non-dead arcs, as suggested in the OpenFst forum:
         https://www.openfst.org/twiki/bin/view/Forum/FstForumArchive2014
+        Dead arcs are hashed by (ilabel, olabel, weight, nextstate) so that each state is filtered in one pass
         """
-        # Group dead arcs by source state [todo: do outside]
+        self._invalidate()
+        # Group dead arcs by source state
         dead_arcs_ = {}
         for (src, t) in dead_arcs:
+            if not isinstance(src, int):
+                src = self.state_index(src)
             if src in dead_arcs_:
-                dead_arcs_[src].append(t)
+                dead_arcs_[src].add(arc_key(t))
             else:
-                dead_arcs_[src] = [t]
+                dead_arcs_[src] = {arc_key(t)}
 
         # Process states with dead arcs
-        for q in filter(lambda q: q in dead_arcs_, self.states()):
+        for q, dead in dead_arcs_.items():
             # Remove all arcs from state
             arcs = [t for t in self.arcs(q)]
             super().delete_arcs(q)
             # Add back live arcs
-            for t1 in arcs:
-                live = True
-                for t2 in dead_arcs_[q]:
-                    if arc_equal(t1, t2):
-                        live = False
-                        break
-                if live:
-                    self.add_arc(q, t1.ilabel, t1.olabel, t1.weight,
-                                 t1.nextstate)
+            for t in arcs:
+                if arc_key(t) not in dead:
+                    super().add_arc(q, t)
         return self
 
     # Copying
@@ -287,8 +631,9 @@ class Fst(pynini.Fst):
     def copy(self):
         """ Deep copy """
 
-        # Preserve input and output symbols
-        fst = Fst(self.input_symbols(), self.output_symbols())
+        # Preserve input and output symbols, and arc type
+        fst = Fst(self.input_symbols(), self.output_symbols(),
+                  self.arc_type())
 
         # Copy states
         q0 = self.start()
@@ -344,6 +689,99 @@ class Fst(pynini.Fst):
 
         return fst_out
 
+    def to_arrays(self):
+        """
+        Whole machine as numpy arrays: src, ilabel, olabel, weight, nextstate (one entry per arc, grouped by source state), offsets (arcs of state q are offsets[q]:offsets[q+1]), final (final weight of each state; inf if not final for tropical / log), and start. Read directly from the OpenFst binary serialization, without creating per-arc python objects; requires tropical or log weights
+        """
+        _check_float_weights(self)
+        n = self.num_states()
+        narcs = np.fromiter((super(Fst, self).num_arcs(q) for q in range(n)),
+                            dtype=np.int64,
+                            count=n)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(narcs, out=offsets[1:])
+
+        # Binary serialization without symbol tables
+        fst = pynini.Fst.copy(self)
+        fst.set_input_symbols(None)
+        fst.set_output_symbols(None)
+        data = np.frombuffer(fst.write_to_string(), dtype=np.uint8)
+        body = data[_header_size(data):]
+        mask = _arc_mask(narcs)
+        arcs = body[mask].view(_arc_dtype)
+        states = body[np.logical_not(mask, out=mask)].view(_state_dtype)
+        del data, body, mask
+        return {
+            'src': np.repeat(np.arange(n, dtype=np.int32), narcs),
+            'ilabel': arcs['ilabel'].copy(),
+            'olabel': arcs['olabel'].copy(),
+            'weight': arcs['weight'].copy(),
+            'nextstate': arcs['nextstate'].copy(),
+            'offsets': offsets,
+            'final': states['final'].copy(),
+            'start': self.start()
+        }
+
+    def from_arrays(self, arrays):
+        """
+        Build machine from numpy arrays in the format of to_arrays (offsets not required; arcs need not be grouped by source state), adding labels from self; assembled as an OpenFst binary serialization and read natively
+        """
+        _check_float_weights(self)
+        final = np.asarray(arrays['final'], dtype=np.float32)
+        src = np.asarray(arrays['src'], dtype=np.int64)
+        n = len(final)
+        m = len(src)
+        order = np.argsort(src, kind='stable')
+        narcs = np.bincount(src, minlength=n)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(narcs, out=offsets[1:])
+
+        states = np.empty(n, dtype=_state_dtype)
+        states['final'] = final
+        states['narcs'] = narcs
+        arcs = np.empty(m, dtype=_arc_dtype)
+        for field in ['ilabel', 'olabel', 'weight', 'nextstate']:
+            arcs[field] = np.asarray(arrays[field])[order]
+
+        # Header, then each state followed by its arcs
+        header = _header(self.arc_type(), arrays.get('start', 0), n)
+        pos0 = len(header)
+        data = np.empty(pos0 + _state_dtype.itemsize * n +
+                        _arc_dtype.itemsize * m,
+                        dtype=np.uint8)
+        data[:pos0] = np.frombuffer(header, dtype=np.uint8)
+        body = data[pos0:]
+        mask = _arc_mask(narcs)
+        body[mask] = arcs.view(np.uint8)
+        body[np.logical_not(mask, out=mask)] = states.view(np.uint8)
+        del mask
+        fst = pynini.Fst.read_from_string(data.tobytes())
+
+        fst_out = Fst(self.input_symbols(), self.output_symbols(),
+                      self.arc_type())
+        fst_out._assign(fst)
+        for q in range(n):
+            q_label = self._state2label.get(q, q)
+            fst_out._state2label[q] = q_label
+            fst_out._label2state[q_label] = q
+        if self.sigma is not None:
+            fst_out.sigma = dict(self.sigma)
+        else:
+            fst_out.sigma = None
+        return fst_out
+
+    def _assign(self, fst):
+        """
+        Replace states and arcs of this machine with those of pynini fst, preserving state ids (native copy; labels are not changed)
+        """
+        fst = pynini.Fst.copy(fst)
+        fst.set_input_symbols(None)
+        fst.set_output_symbols(None)
+        self._invalidate()
+        super().delete_states()
+        super().union(fst)  # Union with empty machine copies fst
+        return self
+
     # Printing
 
     def print(self, **kwargs):
@@ -372,6 +810,332 @@ class Fst(pynini.Fst):
             **kwargs)
 
 
+class _MutableArcIterator():
+    """
+    Mutable arc iterator of Fst that clears the machine's cached results before each write
+    """
+
+    def __init__(self, aiter, fst):
+        self._aiter = aiter
+        self._fst = fst
+
+    def set_value(self, arc):
+        self._fst._invalidate()
+        return self._aiter.set_value(arc)
+
+    def __iter__(self):
+        return iter(self._aiter)
+
+    def __getattr__(self, name):
+        return getattr(self._aiter, name)
+
+
+class FstBuilder():
+    """
+    Buffered construction of an Fst: states, labels, finals, and arcs are collected in compact arrays (with the same interface as Fst for adding them) and the pynini machine is materialized once by build()
+    """
+
+    def __init__(self,
+                 input_symtable=None,
+                 output_symtable=None,
+                 arc_type='standard'):
+        if input_symtable is None:
+            input_symtable = pynini.SymbolTable()
+            input_symtable.add_symbol(config.epsilon)
+        else:
+            input_symtable = input_symtable.copy()
+        if output_symtable is None:
+            output_symtable = input_symtable
+        else:
+            output_symtable = output_symtable.copy()
+        self.input_symtable = input_symtable
+        self.output_symtable = output_symtable
+        self.arc_type = arc_type
+        self._state2label = []  # State id -> label
+        self._label2state = {}  # Label -> state id
+        self._start = None
+        self._finals = {}  # State id -> weight (None: one)
+        self._src = array('l')
+        self._ilabel = array('l')
+        self._olabel = array('l')
+        self._dest = array('l')
+        self._weight = {}  # Arc index -> weight (if not one)
+        self._isym_ids = {}  # Input symbol -> id
+        self._osym_ids = {}  # Output symbol -> id
+
+    # States
+
+    def add_state(self, state_label=None):
+        """ Add new state, optionally specifying its label """
+        if state_label is not None:
+            if state_label in self._label2state:
+                return self._label2state[state_label]
+        state = len(self._state2label)
+        if state_label is None:
+            state_label = state
+        self._state2label.append(state_label)
+        self._label2state[state_label] = state
+        return state
+
+    def set_start(self, state):
+        if not isinstance(state, int):
+            state = self.state_index(state)
+        self._start = state
+
+    def set_final(self, state, weight=None):
+        if not isinstance(state, int):
+            state = self.state_index(state)
+        self._finals[state] = weight
+
+    def state_label(self, state):
+        return self._state2label[state]
+
+    def state_index(self, state):
+        return self._label2state[state]
+
+    def num_states(self):
+        return len(self._state2label)
+
+    # Arcs
+
+    def add_arc(self,
+                src=None,
+                ilabel=None,
+                olabel=None,
+                weight=None,
+                dest=None):
+        """ Add arc (accepts int or string attributes) """
+        if not isinstance(src, int):
+            src = self._label2state[src]
+        if olabel is None:
+            olabel = ilabel
+        if not isinstance(ilabel, int):
+            if ilabel not in self._isym_ids:
+                self._isym_ids[ilabel] = self.input_symtable.add_symbol(ilabel)
+            ilabel = self._isym_ids[ilabel]
+        if not isinstance(olabel, int):
+            if olabel not in self._osym_ids:
+                self._osym_ids[olabel] = \
+                    self.output_symtable.add_symbol(olabel)
+            olabel = self._osym_ids[olabel]
+        if not isinstance(dest, int):
+            dest = self._label2state[dest]
+        if weight is not None:
+            self._weight[len(self._src)] = weight
+        self._src.append(src)
+        self._ilabel.append(ilabel)
+        self._olabel.append(olabel)
+        self._dest.append(dest)
+
+    def num_arcs(self):
+        return len(self._src)
+
+    def build(self):
+        """ Materialize Fst with states, arcs, and labels added so far """
+        fst = Fst(self.input_symtable, self.output_symtable, self.arc_type)
+        n = len(self._state2label)
+        pynini.Fst.add_states(fst, n)
+        if self._start is not None:
+            pynini.Fst.set_start(fst, self._start)
+        one = pynini.Weight.one(fst.weight_type())
+        for q, weight in self._finals.items():
+            if weight is None:
+                weight = one
+            pynini.Fst.set_final(fst, q, weight)
+
+        arc = pynini.Arc(0, 0, one, 0)  # Reused; copied on add
+        arc_weight = one
+        add_arc = pynini.Fst.add_arc
+        weights = self._weight
+        for i, (q, x, y, r) in enumerate(
+                zip(self._src, self._ilabel, self._olabel, self._dest)):
+            w = weights.get(i, one) if weights else one
+            if not isinstance(w, pynini.Weight):
+                w = weights[i] = pynini.Weight(fst.weight_type(), w)
+            arc.ilabel = x
+            arc.olabel = y
+            if w is not arc_weight:
+                arc.weight = arc_weight = w
+            arc.nextstate = r
+            add_arc(fst, q, arc)
+
+        fst._state2label = dict(enumerate(self._state2label))
+        fst._label2state = dict(self._label2state)
+        return fst
+
+
+class FstBudgetError(Exception):
+    """
+    Raised when construction of a machine exceeds its state, arc, or time budget; records the size reached so far
+    """
+
+    def __init__(self, limit, value, num_states, num_arcs, elapsed):
+        self.limit = limit  # 'max_states' | 'max_arcs' | 'timeout'
+        self.value = value  # Value of the limit that was exceeded
+        self.num_states = num_states
+        self.num_arcs = num_arcs
+        self.elapsed = elapsed  # Seconds
+        super().__init__(f'{limit}={value} exceeded after {elapsed:.2f}s '
+                         f'with {num_states} states and {num_arcs} arcs')
+
+
+class _Budget():
+    """
+    Limits on states, arcs, and seconds for a builder (None: unlimited)
+    """
+
+    def __init__(self, max_states=None, max_arcs=None, timeout=None):
+        self.max_states = max_states
+        self.max_arcs = max_arcs
+        self.timeout = timeout
+        self.tic = time.perf_counter()
+
+    def check(self, num_states, num_arcs):
+        elapsed = time.perf_counter() - self.tic
+        if self.max_states is not None and num_states > self.max_states:
+            raise FstBudgetError('max_states', self.max_states, num_states,
+                                 num_arcs, elapsed)
+        if self.max_arcs is not None and num_arcs > self.max_arcs:
+            raise FstBudgetError('max_arcs', self.max_arcs, num_states,
+                                 num_arcs, elapsed)
+        if self.timeout is not None and elapsed > self.timeout:
+            raise FstBudgetError('timeout', self.timeout, num_states,
+                                 num_arcs, elapsed)
+
+    def over_size(self, num_states, num_arcs):
+        """ Whether max_states or max_arcs is exceeded (without timing) """
+        return (self.max_states is not None and
+                num_states > self.max_states) or \
+            (self.max_arcs is not None and num_arcs > self.max_arcs)
+
+    def remaining(self):
+        """ Seconds left before timeout (None if no timeout) """
+        if self.timeout is None:
+            return None
+        return self.timeout - (time.perf_counter() - self.tic)
+
+
+# OpenFst binary serialization of VectorFst with float weights: header, then for each state its final weight, number of arcs, and arcs
+_state_dtype = np.dtype([('final', '<f4'), ('narcs', '<i8')])
+_arc_dtype = np.dtype([('ilabel', '<i4'), ('olabel', '<i4'),
+                       ('weight', '<f4'), ('nextstate', '<i4')])
+_fst_magic = 2125659606
+_fst_version = 2
+_fst_properties = 0x3  # kExpanded | kMutable; others unknown
+
+
+def _check_float_weights(fst):
+    if fst.weight_type() not in ('tropical', 'log'):
+        raise ValueError(
+            f'array conversion requires tropical or log weights '
+            f'(not {fst.weight_type()})')
+
+
+def _header(arc_type, start, num_states):
+    """ Binary header of vector fst without symbol tables """
+    val = struct.pack('<i', _fst_magic)
+    for x in ['vector', arc_type]:
+        x = x.encode('utf-8')
+        val += struct.pack('<i', len(x)) + x
+    val += struct.pack('<iiQqqq', _fst_version, 0, _fst_properties, start,
+                       num_states, 0)
+    return val
+
+
+def _header_size(data):
+    """ Size in bytes of binary header (without symbol tables) """
+    pos = 4
+    for i in range(2):  # fst type, arc type
+        (k,) = struct.unpack_from('<i', data, pos)
+        pos += 4 + k
+    return pos + struct.calcsize('<iiQqqq')
+
+
+def _arc_mask(narcs):
+    """
+    Byte mask of arc records in the body of a binary serialization (after the header), where each state record is followed by the records of its narcs arcs; built by repeating one flag per record, without a byte index
+    """
+    n = len(narcs)
+    sizes = np.empty(2 * n, dtype=np.int64)
+    sizes[0::2] = _state_dtype.itemsize
+    sizes[1::2] = _arc_dtype.itemsize * narcs
+    is_arc = np.zeros(2 * n, dtype=bool)
+    is_arc[1::2] = True
+    return np.repeat(is_arc, sizes)
+
+
+def read_fst(filename, state2label=None):
+    """
+    Read machine written by Fst.write() (pynini binary with symbol tables); states are labeled by index unless state2label is given
+    """
+    return _from_native(pynini.Fst.read(filename), state2label)
+
+
+def _from_native(fst, state2label=None):
+    """ Fst with the states, arcs, and symbols of pynini fst """
+    fst_out = Fst(fst.input_symbols(), fst.output_symbols(), fst.arc_type())
+    fst_out._assign(fst)
+    if state2label is None:
+        state2label = {q: q for q in range(fst_out.num_states())}
+    fst_out._state2label = dict(state2label)
+    fst_out._label2state = {label: q for q, label in state2label.items()}
+    return fst_out
+
+
+# Worker processes for Fst.transduce_parallel
+_worker_fst = None
+
+
+def _init_worker(fst_bytes, state2label):
+    """ Rebuild labeled machine from pynini binary in worker process """
+    global _worker_fst
+    fst = pynini.Fst.read_from_string(fst_bytes)
+    _worker_fst = _from_native(fst, state2label)
+
+
+def _transduce_chunk(chunk):
+    """ Transduce chunk (start index, inputs) in worker process """
+    i, X = chunk
+    return i, _worker_fst.transduce_many(X)
+
+
+def _reachable(offsets, nextstate, Q):
+    """
+    Boolean mask of states reachable from states Q in CSR adjacency
+    """
+    n = len(offsets) - 1
+    visited = np.zeros(n, dtype=bool)
+    visited[Q] = True
+    frontier = Q
+    while len(frontier) != 0:
+        start = offsets[frontier]
+        narcs = offsets[frontier + 1] - start
+        total = narcs.sum()
+        if total == 0:
+            break
+        # Indices of all arcs leaving frontier states
+        idx = np.repeat(start - np.cumsum(narcs) + narcs, narcs) \
+            + np.arange(total)
+        dest = nextstate[idx]
+        frontier = np.unique(dest[~visited[dest]])
+        visited[frontier] = True
+    return visited
+
+
+def _tolist(x):
+    """ List of python values from sequence or numpy array """
+    if hasattr(x, 'tolist'):
+        return x.tolist()
+    return list(x)
+
+
+def arc_key(arc):
+    """
+    Hashable key of arc, equal for arcs that are equal by arc_equal
+    """
+    return (arc.ilabel, arc.olabel, arc.weight.to_string(), arc.nextstate)
+
+
 def arc_equal(arc1, arc2):
     """
     Arc equality (missing from pynini?)
@@ -383,84 +1147,509 @@ def arc_equal(arc1, arc2):
     return val
 
 
-def compose(fst1, fst2):
+def compose(fst1,
+            fst2,
+            native=False,
+            max_states=None,
+            max_arcs=None,
+            timeout=None):
     """
     FST composition, retaining contextual info from original machines by labeling each state q = (q1, q2) with (label(q1), label(q2))
-    todo: matcher options; flatten lists
+    Arcs of fst2 are indexed by input label on first visit to each state, so each state pair only touches matching arcs; with native=True the product is built by pynini (see _compose_native)
+    Raises FstBudgetError if the product (before trimming) exceeds max_states, max_arcs, or timeout (seconds); sizes are checked after each arc, time before expanding each state, or all only once pynini returns if native=True
+    todo: flatten lists
     """
-    fst = Fst(config.symtable)
-    Zero = pynini.Weight.zero(fst.weight_type())
+    budget = _Budget(max_states, max_arcs, timeout)
+    if native:
+        fst = _compose_native(fst1, fst2)
+        budget.check(fst.num_states(), fst.num_arcs())
+        return fst
+    fst = FstBuilder(config.symtable)
+    Zero = pynini.Weight.zero(fst1.weight_type())
 
     q0_1 = fst1.start()
     q0_2 = fst2.start()
-    q0 = (fst1.state_label(q0_1), fst2.state_label(q0_2))
-    fst.add_state(q0)
+    q0 = fst.add_state((fst1.state_label(q0_1), fst2.state_label(q0_2)))
     fst.set_start(q0)
+    if fst1.final(q0_1) != Zero and fst2.final(q0_2) != Zero:
+        fst.set_final(q0)
+
+    # Input-label matcher for fst2, built lazily per state
+    index2 = {}
 
     # Lazy state and transition construction
-    Q = set([q0])
-    Q_old, Q_new = set(), set([q0])
+    Q = set([(q0_1, q0_2)])
+    Q_old, Q_new = set(), set(Q)
     while len(Q_new) != 0:
         Q_old, Q_new = Q_new, Q_old
         Q_new.clear()
-        for src in Q_old:
-            src1, src2 = src  # State labels in M1, M2
+        for (src1, src2) in Q_old:  # State ids in M1, M2
+            budget.check(fst.num_states(), fst.num_arcs())
+            src = fst.state_index((fst1.state_label(src1),
+                                   fst2.state_label(src2)))
+            if src2 not in index2:
+                index2[src2] = _arcs_by_ilabel(fst2, src2)
+            arcs2 = index2[src2]
+            if len(arcs2) == 0:
+                continue
             for t1 in fst1.arcs(src1):
-                for t2 in fst2.arcs(src2):  # (todo: sort arcs)
-                    if t1.olabel != t2.ilabel:
-                        continue
+                for t2 in arcs2.get(t1.olabel, ()):
                     dest1 = t1.nextstate
                     dest2 = t2.nextstate
                     dest = (fst1.state_label(dest1), fst2.state_label(dest2))
-                    fst.add_state(dest)  # No change if state already exists
+                    dest = fst.add_state(dest)  # No change if state exists
                     fst.add_arc(
                         src=src, ilabel=t1.ilabel, olabel=t2.olabel, dest=dest)
-                    if fst1.final(dest1) != Zero and fst2.final(dest2) != Zero:
-                        fst.set_final(dest)  # Final if both dest1, dest2 are
-                    if dest not in Q:
-                        Q.add(dest)
-                        Q_new.add(dest)
+                    if budget.over_size(fst.num_states(), fst.num_arcs()):
+                        budget.check(fst.num_states(), fst.num_arcs())
+                    if (dest1, dest2) not in Q:
+                        if fst1.final(dest1) != Zero and \
+                            fst2.final(dest2) != Zero:
+                            fst.set_final(dest)  # Final if dest1, dest2 are
+                        Q.add((dest1, dest2))
+                        Q_new.add((dest1, dest2))
+
+    budget.check(fst.num_states(), fst.num_arcs())
+    return fst.build().connect(inplace=True)
+
+
+def compose_many(fsts,
+                 native=False,
+                 max_states=None,
+                 max_arcs=None,
+                 timeout=None):
+    """
+    Composition of a cascade of machines M1 o ... o Mn, associated in the order with the least estimated intermediate size (see _compose_order); each state is labeled with the flat tuple (label(q1), ..., label(qn))
+    Limits apply to each intermediate product, and timeout to the whole cascade (see compose)
+    """
+    budget = _Budget(max_states, max_arcs, timeout)
+    fsts = list(fsts)
+    match = [_label_match(fsts[k], fsts[k + 1]) for k in range(len(fsts) - 1)]
+    tree, _ = _compose_order(fsts, match, 0, len(fsts) - 1, {})
+
+    def _compose_tree(tree):
+        if isinstance(tree, int):
+            return fsts[tree], False
+        fst1, flat1 = _compose_tree(tree[0])
+        fst2, flat2 = _compose_tree(tree[1])
+        try:
+            fst = compose(
+                fst1,
+                fst2,
+                native=native,
+                max_states=max_states,
+                max_arcs=max_arcs,
+                timeout=budget.remaining())
+        except FstBudgetError as e:
+            # Report timeout and elapsed time of the whole cascade
+            if e.limit == 'timeout':
+                raise FstBudgetError('timeout', timeout, e.num_states,
+                                     e.num_arcs,
+                                     time.perf_counter() - budget.tic)
+            raise
+        # Flatten (label(q1), label(q2)), where labels of intermediate machines are already flat tuples
+        state2label = {}
+        for q, (label1, label2) in fst._state2label.items():
+            label1 = label1 if flat1 else (label1,)
+            label2 = label2 if flat2 else (label2,)
+            state2label[q] = label1 + label2
+        fst._state2label = state2label
+        fst._label2state = {label: q for q, label in state2label.items()}
+        return fst, True
+
+    fst, flat = _compose_tree(tree)
+    if not flat:
+        fst = fst.copy()
+        fst._state2label = {
+            q: (label,) for q, label in fst._state2label.items()
+        }
+        fst._label2state = {label: q for q, label in fst._state2label.items()}
+    return fst
 
-    return fst.connect()
+
+def _compose_order(fsts, match, i, j, memo):
+    """
+    Association order for composing fsts[i..j], chosen by dynamic programming as for matrix chains. The product of two machines is estimated to have |Q1| * |Q2| states, each with d1 * d2 * p outgoing arcs, where d is the mean out-degree and p is the probability that the output label of a random arc of the first machine matches the input label of a random arc of the second (match[k] for fsts[k], fsts[k + 1]). Returns (tree, (states, degree, cost)) with tree a nested pair of indices into fsts and cost the summed estimated arcs of all intermediate products
+    """
+    if (i, j) in memo:
+        return memo[(i, j)]
+    if i == j:
+        fst = fsts[i]
+        num_states = max(fst.num_states(), 1)
+        degree = fst.num_arcs() / num_states
+        memo[(i, j)] = (i, (num_states, degree, 0.0))
+        return memo[(i, j)]
+
+    best = None
+    for k in range(i, j):
+        tree1, (states1, degree1, cost1) = \
+            _compose_order(fsts, match, i, k, memo)
+        tree2, (states2, degree2, cost2) = \
+            _compose_order(fsts, match, k + 1, j, memo)
+        states = states1 * states2
+        degree = degree1 * degree2 * match[k]
+        cost = cost1 + cost2 + states * degree
+        if best is None or cost < best[1][2]:
+            best = ((tree1, tree2), (states, degree, cost))
+    memo[(i, j)] = best
+    return best
+
+
+def _label_match(fst1, fst2):
+    """
+    Probability that output label of random arc in fst1 equals input label of random arc in fst2
+    """
+    olabels, ilabels = {}, {}
+    for q in fst1.states():
+        for t in fst1.arcs(q):
+            olabels[t.olabel] = olabels.get(t.olabel, 0) + 1
+    for q in fst2.states():
+        for t in fst2.arcs(q):
+            ilabels[t.ilabel] = ilabels.get(t.ilabel, 0) + 1
+    n1 = sum(olabels.values())
+    n2 = sum(ilabels.values())
+    if n1 == 0 or n2 == 0:
+        return 0.0
+    val = 0.0
+    for x, c in olabels.items():
+        val += (c / n1) * (ilabels.get(x, 0) / n2)
+    return val
+
+
+def _compose_native(fst1, fst2):
+    """
+    Composition by pynini with state labels recovered afterward. Arcs of fst1 (fst2) are encoded with unique ids on their input (output) side, which does not take part in matching, so that each arc of the result identifies the pair of arcs that produced it. Uses the null composition filter, under which epsilon is matched like any other label as in compose(); weights are removed from the result, which is unweighted with standard arcs as in compose()
+    """
+    M1, arcs1 = _encode_arcs(fst1, side='input')
+    M2, arcs2 = _encode_arcs(fst2, side='output')
+    M2.arcsort(sort_type='ilabel')
+    M = pynini.compose(M1, M2, compose_filter='null', connect=True)
+    M = pynini.arcmap(M, map_type='rmweight')
+    if M.arc_type() != 'standard':
+        M = pynini.arcmap(M, map_type='to_std')
+
+    # Decode arcs and recover state pairs from the initial state
+    q0 = M.start()
+    if q0 == pynini.NO_STATE_ID:
+        return Fst(config.symtable)
+    Q = {q0: (fst1.start(), fst2.start())}
+    Q_new = [q0]
+    while len(Q_new) != 0:
+        src = Q_new.pop()
+        aiter = M.mutable_arcs(src)
+        while not aiter.done():
+            t = aiter.value()
+            ilabel, dest1 = arcs1[t.ilabel]
+            olabel, dest2 = arcs2[t.olabel]
+            if t.nextstate not in Q:
+                Q[t.nextstate] = (dest1, dest2)
+                Q_new.append(t.nextstate)
+            t.ilabel = ilabel
+            t.olabel = olabel
+            aiter.set_value(t)
+            aiter.next()
+
+    fst = Fst(config.symtable)._assign(M)
+    for q, (q1, q2) in Q.items():
+        q_label = (fst1.state_label(q1), fst2.state_label(q2))
+        fst._state2label[q] = q_label
+        fst._label2state[q_label] = q
+    return fst
+
+
+def _encode_arcs(fst, side='input'):
+    """
+    Copy of fst with the labels on one side replaced by arc ids (starting at 1), and list mapping each arc id to its original label and destination
+    """
+    M = pynini.Fst.copy(fst)
+    M.set_input_symbols(None)
+    M.set_output_symbols(None)
+    arcs = [None]
+    for q in M.states():
+        aiter = M.mutable_arcs(q)
+        while not aiter.done():
+            t = aiter.value()
+            if side == 'input':
+                arcs.append((t.ilabel, t.nextstate))
+                t.ilabel = len(arcs) - 1
+            else:
+                arcs.append((t.olabel, t.nextstate))
+                t.olabel = len(arcs) - 1
+            aiter.set_value(t)
+            aiter.next()
+    return M, arcs
+
+
+def _arcs_by_ilabel(fst, src):
+    """ Outgoing arcs of state src grouped by input label id """
+    index = {}
+    for t in fst.arcs(src):
+        if t.ilabel in index:
+            index[t.ilabel].append(t)
+        else:
+            index[t.ilabel] = [t]
+    return index
 
 
 def accepted_strings(fst, side='input', max_len=10):
     """
     Strings accepted by fst on designated side, up to max_len (not including bos/eos); cf. pynini for paths through acyclic fst
-    todo: epsilon-handling
     """
+    return set(iter_accepted_strings(fst, side, max_len))
+
+
+def iter_accepted_strings(fst, side='input', max_len=10):
+    """
+    Generate strings accepted by fst on designated side, up to max_len (not including bos/eos), in order of length and each only once. Prefixes are nodes of a trie shared by all paths, stored as parent pointers and labels in arrays; epsilons do not extend prefixes (or count toward length)
+    """
+    return _unique_strings(fst, side, max_len + 2)
+
+
+def _unique_strings(fst, side, max_symbols):
+    """ Generator for iter_accepted_strings, up to max_symbols """
     q0 = fst.start()
+    if q0 < 0:
+        return
     Zero = pynini.Weight.zero(fst.weight_type())
+    if side == 'input':
+        symbols = fst.input_symbols()
+    else:
+        symbols = fst.output_symbols()
+    symbols = {sym_id: sym for (sym_id, sym) in symbols}
 
-    accepted = set()
-    prefixes_old = {(q0, None)}
-    prefixes_new = set(prefixes_old)
-    for i in range(max_len + 2):
-        prefixes_old, prefixes_new = prefixes_new, prefixes_old
-        prefixes_new.clear()
-        for (src, prefix) in prefixes_old:
+    # Finality and outgoing arcs of each visited state: epsilon
+    # destinations and (label, destination) pairs
+    arcs = {}
+
+    def _arcs(src):
+        if src not in arcs:
+            eps, T = [], []
             for t in fst.arcs(src):
-                dest = t.nextstate
-                if side == 'input':
-                    tlabel = fst.input_label(t.ilabel)
-                else:
-                    tlabel = fst.output_label(t.olabel)
-                if prefix is None:
-                    prefix_ = tlabel
+                x = t.ilabel if side == 'input' else t.olabel
+                if x == 0:
+                    eps.append(t.nextstate)
                 else:
-                    prefix_ = prefix + ' ' + tlabel
-                prefixes_new.add((dest, prefix_))
-                if fst.final(dest) != Zero:
-                    accepted.add(prefix_)
-                    #print(prefix_)
+                    T.append((x, t.nextstate))
+            arcs[src] = (fst.final(src) != Zero, eps, T)
+        return arcs[src]
+
+    # Trie of prefixes (node 0 is the empty prefix)
+    parent = array('l', [-1])
+    label = array('l', [0])
+
+    frontier = {(q0, 0)}  # (state, prefix node)
+    for i in range(max_symbols + 1):
+        # Epsilon closure
+        stack = list(frontier)
+        while len(stack) != 0:
+            (src, node) = stack.pop()
+            for dest in _arcs(src)[1]:
+                if (dest, node) not in frontier:
+                    frontier.add((dest, node))
+                    stack.append((dest, node))
+
+        # Accepted prefixes of length i
+        accepted = set()
+        for (q, node) in frontier:
+            if node not in accepted and arcs[q][0]:
+                accepted.add(node)
+                yield _trie_string(node, parent, label, symbols)
+        if i == max_symbols:
+            break
+
+        # Extend prefixes by one symbol
+        children = {}  # (node, label) -> node
+        frontier_new = set()
+        for (src, node) in frontier:
+            for (x, dest) in _arcs(src)[2]:
+                child = children.get((node, x))
+                if child is None:
+                    child = len(parent)
+                    parent.append(node)
+                    label.append(x)
+                    children[(node, x)] = child
+                frontier_new.add((dest, child))
+        frontier = frontier_new
+        if len(frontier) == 0:
+            break
+
+
+def _trie_string(node, parent, label, symbols):
+    """ Space-separated string of trie node, following parent pointers """
+    val = []
+    while node > 0:
+        val.append(symbols[label[node]])
+        node = parent[node]
+    return ' '.join(reversed(val))
+
+
+def _path_strings(fst, side, max_len, limit, unique, order):
+    """
+    Strings on designated side of paths through fst, with at most max_len symbols (see Fst.istrings)
+    """
+    if order not in ('length', 'weight'):
+        raise ValueError(f'unknown order {order}')
+    if order == 'weight':
+        if limit is None:
+            raise ValueError('order by weight requires limit')
+        strings = _nbest_strings(fst, side, max_len, limit, unique)
+    elif unique:
+        strings = _unique_strings(fst, side, max_len)
+    else:
+        strings = _all_strings(fst, side, max_len)
+    return itertools.islice(strings, limit)
+
+
+def _all_strings(fst, side, max_len):
+    """
+    String of each path with at most max_len symbols, in order of length: depth-first search for paths with exactly n symbols for n = 0, ..., max_len (iterative deepening, so memory is bounded by max_len); paths that return to a state by epsilons alone are skipped
+    """
+    q0 = fst.start()
+    if q0 < 0:
+        return
+    Zero = pynini.Weight.zero(fst.weight_type())
+    symbols = fst.input_symbols() if side == 'input' \
+        else fst.output_symbols()
+    symbols = {sym_id: sym for (sym_id, sym) in symbols}
+
+    # Finality and outgoing (label, destination) pairs of visited states,
+    # in reverse order for the stack
+    arcs = {}
+
+    def _arcs(src):
+        if src not in arcs:
+            T = [(t.ilabel if side == 'input' else t.olabel, t.nextstate)
+                 for t in fst.arcs(src)]
+            arcs[src] = (fst.final(src) != Zero, T[::-1])
+        return arcs[src]
+
+    for n in range(max_len + 1):
+        # (state, prefix, states visited since last symbol)
+        stack = [(q0, (), (q0,))]
+        while len(stack) != 0:
+            (src, x, visited) = stack.pop()
+            final, T = _arcs(src)
+            if final and len(x) == n:
+                yield ' '.join([symbols[x_i] for x_i in x])
+            for (x_i, dest) in T:
+                if x_i == 0:
+                    if dest not in visited:
+                        stack.append((dest, x, visited + (dest,)))
+                elif len(x) < n:
+                    stack.append((dest, x + (x_i,), (dest,)))
+
+
+def _nbest_strings(fst, side, max_len, limit, unique):
+    """
+    Strings with at most max_len symbols in order of path weight, by n-shortest paths (tropical) on the projection of fst restricted to max_len symbols; if unique, each string once with its best weight
+    """
+    M = pynini.Fst.copy(fst)
+    M.project(side)
+    if M.arc_type() != 'standard':
+        M = pynini.arcmap(M, map_type='to_std')
+    if unique:
+        # Also merges paths for the same string (not wanted otherwise)
+        M.rmepsilon()
+    symbols = M.input_symbols()
+
+    # Acceptor of all strings with at most max_len symbols
+    A = pynini.Fst()
+    for i in range(max_len + 1):
+        A.add_state()
+        A.set_final(i)
+    for i in range(max_len):
+        for sym_id, _ in symbols:
+            if sym_id != 0:
+                A.add_arc(i, pynini.Arc(sym_id, sym_id, 0, i + 1))
+    A.set_start(0)
+    M.arcsort(sort_type='olabel')
+    M = pynini.compose(M, A)
+    for (x, w) in _nshortest(M, limit, unique, symbols):
+        yield x
+
+
+def _nshortest(M, n, unique, symbols):
+    """
+    Strings of the n shortest paths through tropical acceptor M (each string once if unique) with their weights as floats, in order of weight
+    """
+    M = pynini.shortestpath(M, nshortest=n, unique=unique)
+    strings = []
+    paths = M.paths(input_token_type=symbols)
+    while not paths.done():
+        strings.append((paths.istring(), float(paths.weight())))
+        paths.next()
+    strings.sort(key=lambda s: s[1])
+    return strings
+
 
-    return accepted
+def count_accepted(fst, side='input', max_len=10, deterministic=False):
+    """
+    Number of strings of each length 0, ..., max_len + 2 (bos/eos included) accepted by fst on designated side, as float64 array; computed by propagating a vector of path counts over states, in time proportional to machine size times max_len. Counts successful paths, so that strings accepted on more than one path are counted more than once, unless deterministic=True (count over the determinized, epsilon-free projection, which has one path per string as in accepted_strings). Raises ValueError on epsilon cycles
+    """
+    if deterministic:
+        fst = _projection(fst, side, deterministic=True)
+    n = fst.num_states()
+    counts = np.zeros(max_len + 3)
+    q0 = fst.start()
+    if q0 < 0:
+        return counts
+    arrays = fst.to_arrays()
+    label = arrays['ilabel'] if side == 'input' else arrays['olabel']
+    src, nextstate = arrays['src'], arrays['nextstate']
+    eps = (label == 0)
+    src_eps, dest_eps = src[eps], nextstate[eps]
+    src_sym, dest_sym = src[~eps], nextstate[~eps]
+    zero = float(pynini.Weight.zero(fst.weight_type()))
+    final = (arrays['final'] != zero)
+
+    c = np.zeros(n)  # Paths from start state to each state
+    c[q0] = 1.0
+    for i in range(max_len + 3):
+        # Epsilon closure (paths through at most n epsilon arcs)
+        if len(src_eps) != 0:
+            c_eps = c
+            for k in range(n + 1):
+                c_eps = np.bincount(dest_eps, c_eps[src_eps], minlength=n)
+                if not np.any(c_eps):
+                    break
+                c = c + c_eps
+            else:
+                raise ValueError('epsilon cycle on accessible path')
+        counts[i] = c[final].sum()
+        if i == max_len + 2:
+            break
+        c = np.bincount(dest_sym, c[src_sym], minlength=n)
+        if not np.any(c):
+            break
+    return counts
 
 
-def left_context_acceptor(context_length=1, sigma_tier=None):
+def _projection(fst, side='input', deterministic=True):
+    """
+    Epsilon-free projection of fst on designated side, with states labeled by index; if deterministic, also unweighted and determinized (one path per accepted string), otherwise with log weights (so that epsilon removal sums the weights of converging paths)
+    """
+    M = pynini.Fst.copy(fst)
+    M.project(side)
+    if deterministic:
+        M = pynini.arcmap(M, map_type='rmweight')
+    elif M.arc_type() != 'log':
+        M = pynini.arcmap(M, map_type='to_log')
+    M.rmepsilon()
+    if deterministic:
+        M = pynini.determinize(M)
+    return _from_native(M)
+
+
+def left_context_acceptor(context_length=1,
+                           sigma_tier=None,
+                           max_states=None,
+                           max_arcs=None,
+                           timeout=None):
     """
     Acceptor (identity transducer) for segments in immediately preceding contexts (histories) of specified length. If Sigma_tier is specified as  a subset of Sigma, only contexts over Sigma_tier are tracked (other member of Sigma are skipped, i.e., label self-loops on each interior state)
+    Raises FstBudgetError if construction exceeds max_states, max_arcs, or timeout (seconds)
     """
+    budget = _Budget(max_states, max_arcs, timeout)
     epsilon = config.epsilon
     bos = config.bos
     eos = config.eos
@@ -469,7 +1658,7 @@ def left_context_acceptor(context_length=1, sigma_tier=None):
         sigma_skip = set()
     else:
         sigma_skip = set(config.sigma) - sigma_tier
-    fst = Fst(config.symtable)
+    fst = FstBuilder(config.symtable)
 
     # Initial and peninitial states
     q0 = ('λ',)
@@ -489,6 +1678,7 @@ def left_context_acceptor(context_length=1, sigma_tier=None):
         for q1 in Qold:
             if q1 == q0:
                 continue
+            budget.check(fst.num_states(), fst.num_arcs())
             for x in sigma_tier:
                 q2 = _suffix(q1, context_length - 1) + (x,)
                 fst.add_state(q2)
@@ -514,13 +1704,20 @@ def left_context_acceptor(context_length=1, sigma_tier=None):
         for x in sigma_skip:
             fst.add_arc(src=q, ilabel=x, dest=q)
 
-    return fst
+    budget.check(fst.num_states(), fst.num_arcs())
+    return fst.build()
 
 
-def right_context_acceptor(context_length=1, sigma_tier=None):
+def right_context_acceptor(context_length=1,
+                           sigma_tier=None,
+                           max_states=None,
+                           max_arcs=None,
+                           timeout=None):
     """
     Acceptor (identity transducer) for segments in immediately following contexts (futures) of specified length. If Sigma_tier is specified as a subset of Sigma, only contexts over Sigma_tier are tracked (other members of Sigma are skipped, i.e., label self-loops on each interior state)
+    Raises FstBudgetError if construction exceeds max_states, max_arcs, or timeout (seconds)
     """
+    budget = _Budget(max_states, max_arcs, timeout)
     epsilon = config.epsilon
     bos = config.bos
     eos = config.eos
@@ -529,7 +1726,7 @@ def right_context_acceptor(context_length=1, sigma_tier=None):
         sigma_skip = set()
     else:
         sigma_skip = set(config.sigma) - sigma_tier
-    fst = Fst(config.symtable)
+    fst = FstBuilder(config.symtable)
 
     # Final and penultimate state
     qf = ('λ',)
@@ -549,6 +1746,7 @@ def right_context_acceptor(context_length=1, sigma_tier=None):
         for q2 in Qold:
             if q2 == qf:
                 continue
+            budget.check(fst.num_states(), fst.num_arcs())
             for x in sigma_tier:
                 q1 = (x,) + _prefix(q2, context_length - 1)
                 fst.add_state(q1)
@@ -574,7 +1772,8 @@ def right_context_acceptor(context_length=1, sigma_tier=None):
         for x in sigma_skip:
             fst.add_arc(src=q, ilabel=x, dest=q)
 
-    return fst
+    budget.check(fst.num_states(), fst.num_arcs())
+    return fst.build()
 
 
 def _prefix(x, l):
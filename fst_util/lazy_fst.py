@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict, namedtuple
+import pynini
+from .fst import _arcs_by_ilabel
+
+LazyArc = namedtuple('LazyArc', ['ilabel', 'olabel', 'weight', 'nextstate'])
+
+
+class LazyComposeFst():
+    """
+    On-demand composition of fst1 and fst2. States are pairs (q1, q2) of states in the original machines, labeled with (label(q1), label(q2)) as in compose(); a state's arcs are constructed only when it is visited and memoized in a bounded LRU cache. Operands can be Fsts or other LazyComposeFsts (for cascades).
+    """
+
+    def __init__(self, fst1, fst2, cache_size=10000):
+        self.fst1 = fst1
+        self.fst2 = fst2
+        self.cache_size = cache_size  # Max expanded states (None: unbounded)
+        self._cache = OrderedDict()  # State -> outgoing arcs
+        self._one = pynini.Weight.one(fst1.weight_type())
+        self._zero = pynini.Weight.zero(fst1.weight_type())
+
+    # States
+
+    def start(self):
+        return (self.fst1.start(), self.fst2.start())
+
+    def final(self, state):
+        q1, q2 = state
+        if self.fst1.final(q1) != self._zero and \
+            self.fst2.final(q2) != self._zero:
+            return self._one
+        return self._zero
+
+    def is_final(self, state):
+        return self.final(state) != self._zero
+
+    def state_label(self, state):
+        q1, q2 = state
+        return (self.fst1.state_label(q1), self.fst2.state_label(q2))
+
+    def weight_type(self):
+        return self.fst1.weight_type()
+
+    # Arcs
+
+    def arcs(self, state):
+        """ Outgoing arcs of state, expanded on first visit """
+        if state in self._cache:
+            self._cache.move_to_end(state)
+            return self._cache[state]
+        q1, q2 = state
+        arcs2 = _arcs_by_ilabel(self.fst2, q2)
+        T = []
+        if len(arcs2) != 0:
+            for t1 in self.fst1.arcs(q1):
+                for t2 in arcs2.get(t1.olabel, ()):
+                    dest = (t1.nextstate, t2.nextstate)
+                    T.append(LazyArc(t1.ilabel, t2.olabel, self._one, dest))
+        self._cache[state] = T
+        if self.cache_size is not None and len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return T
+
+    def input_symbols(self):
+        return self.fst1.input_symbols()
+
+    def output_symbols(self):
+        return self.fst2.output_symbols()
+
+    def input_label(self, sym_id):
+        return self.input_symbols().find(sym_id)
+
+    def output_label(self, sym_id):
+        return self.output_symbols().find(sym_id)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    # Algorithms
+
+    def transduce(self, x):
+        """
+        Transduce space-separated input x, visiting only the states reachable on x (assumes no cycles on input epsilon); returns distinct output strings
+        """
+        isymbols = self.input_symbols()
+        xs = []
+        for sym in x.split():
+            sym_id = isymbols.find(sym)
+            if sym_id == pynini.NO_SYMBOL:
+                return []
+            xs.append(sym_id)
+        n = len(xs)
+
+        # Breadth-first search over (state, position, output) configurations
+        Y = []
+        q0 = self.start()
+        C = set([(q0, 0, ())])
+        C_new = [(q0, 0, ())]
+        while len(C_new) != 0:
+            C_old, C_new = C_new, []
+            for (src, i, y) in C_old:
+                if i == n and self.is_final(src):
+                    Y.append(y)
+                for t in self.arcs(src):
+                    if t.ilabel == 0:
+                        j = i
+                    elif i < n and t.ilabel == xs[i]:
+                        j = i + 1
+                    else:
+                        continue
+                    y_ = y if t.olabel == 0 else y + (t.olabel,)
+                    c = (t.nextstate, j, y_)
+                    if c not in C:
+                        C.add(c)
+                        C_new.append(c)
+
+        Y = [' '.join([self.output_label(y_i) for y_i in y]) for y in Y]
+        Y = list(dict.fromkeys(Y))
+        return Y
+
+    def paths(self, max_len=10):
+        """
+        Generate (input, output) string pairs of successful paths with at most max_len arcs, expanding states depth-first
+        """
+        q0 = self.start()
+        stack = [(q0, 0, (), ())]
+        while len(stack) != 0:
+            (src, k, x, y) = stack.pop()
+            if self.is_final(src):
+                yield (' '.join([self.input_label(x_i) for x_i in x]),
+                       ' '.join([self.output_label(y_i) for y_i in y]))
+            if k == max_len:
+                continue
+            for t in reversed(self.arcs(src)):
+                x_ = x if t.ilabel == 0 else x + (t.ilabel,)
+                y_ = y if t.olabel == 0 else y + (t.olabel,)
+                stack.append((t.nextstate, k + 1, x_, y_))
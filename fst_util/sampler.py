@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from .fst import _projection
+
+
+class StringSampler():
+    """
+    Random strings accepted by fst on designated side, with at most max_len + 2 symbols (bos/eos included, as in accepted_strings). Uniform over distinct strings by default (sampled from the determinized projection); if weighted=True, each string is drawn with probability proportional to the sum of its path weights, with weights as negative log probabilities (tropical or log). Suffix totals for each state and remaining length are computed once, after which each draw takes O(length)
+    """
+
+    def __init__(self, fst, side='input', max_len=10, weighted=False,
+                 seed=None):
+        self.side = side
+        self.max_len = max_len
+        self.weighted = weighted
+        self.rng = np.random.default_rng(seed)
+        M = _projection(fst, side, deterministic=not weighted)
+        symbols = fst.input_symbols() if side == 'input' \
+            else fst.output_symbols()
+        self.symbols = {sym_id: sym for (sym_id, sym) in symbols}
+        self.start = M.start()
+
+        arrays = M.to_arrays()
+        n = M.num_states()
+        src, nextstate = arrays['src'], arrays['nextstate']
+        self.label = arrays['ilabel']
+        self.offsets = arrays['offsets']
+        if weighted:
+            w_arc = np.exp(-arrays['weight'].astype(np.float64))
+            w_final = np.exp(-arrays['final'].astype(np.float64))
+        else:
+            w_arc = np.ones(len(src))
+            w_final = np.isfinite(arrays['final']).astype(np.float64)
+
+        # Total weight of suffixes of each length k from each state
+        K = max_len + 3
+        suffix = np.zeros((K, n))
+        suffix[0] = w_final
+        for k in range(1, K):
+            suffix[k] = np.bincount(src,
+                                    w_arc * suffix[k - 1][nextstate],
+                                    minlength=n)
+        self.suffix = suffix
+
+        # Cumulative arc probabilities within each state, given remaining
+        # length k, offset by state index so that each row is nondecreasing
+        # and arcs can be selected for many states at once by binary search
+        narcs = np.diff(self.offsets)
+        last = np.maximum(self.offsets[1:] - 1, 0)
+        self.cumprob = np.zeros((K, len(src)))
+        for k in range(1, K if len(src) != 0 else 1):
+            total = suffix[k][src]
+            p = np.divide(w_arc * suffix[k - 1][nextstate],
+                          total,
+                          out=np.zeros(len(src)),
+                          where=(total > 0))
+            cum = np.cumsum(p)
+            cum -= np.repeat(cum[last] - np.bincount(src, p, minlength=n),
+                             narcs)
+            # Last arc of each state with suffixes at exactly 1
+            cum_last = np.repeat(cum[last], narcs)
+            cum = np.divide(cum, cum_last, out=cum, where=(cum_last > 0))
+            self.cumprob[k] = src + cum
+        self._nextstate = nextstate
+
+    def length_probs(self):
+        """ Probability of each string length 0, ..., max_len + 2 """
+        if self.start < 0:
+            return np.zeros(self.max_len + 3)
+        mass = self.suffix[:, self.start]
+        total = mass.sum()
+        if total == 0:
+            return mass
+        return mass / total
+
+    def sample_ids(self, n=1):
+        """
+        Draw n strings as (n x max length) array of symbol ids padded with 0, and array of lengths (cf. EncodedCorpus.padded)
+        """
+        probs = self.length_probs()
+        if probs.sum() == 0:
+            raise ValueError(f'no accepted strings of length '
+                             f'<= {self.max_len + 2}')
+        lengths = self.rng.choice(len(probs), size=n, p=probs)
+        width = int(lengths.max()) if n > 0 else 0
+        X = np.zeros((n, width), dtype=np.int32)
+        Q = np.full(n, self.start, dtype=np.int64)
+        for i in range(width):
+            # Strings still being drawn, grouped by remaining length
+            remaining = lengths - i
+            for k in np.unique(remaining[remaining > 0]):
+                idx = np.flatnonzero(remaining == k)
+                u = self.rng.random(len(idx))
+                arc = np.searchsorted(self.cumprob[k], Q[idx] + u,
+                                      side='right')
+                arc = np.minimum(arc, self.offsets[Q[idx] + 1] - 1)
+                X[idx, i] = self.label[arc]
+                Q[idx] = self._nextstate[arc]
+        return X, lengths
+
+    def sample(self, n=None):
+        """
+        Draw one space-separated string, or list of n strings
+        """
+        X, lengths = self.sample_ids(1 if n is None else n)
+        symbols = self.symbols
+        strings = [
+            ' '.join([symbols[x] for x in X[i, :lengths[i]].tolist()])
+            for i in range(len(lengths))
+        ]
+        if n is None:
+            return strings[0]
+        return strings
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pynini
+from .fst import _from_native
+from .corpus import EncodedCorpus
+
+
+class ForwardScorer():
+    """
+    Batch scoring of input strings by a weighted machine. The score of a string is the sum (log semiring) or minimum (tropical semiring) of the weights of its paths, as by pynini shortestdistance on the composition of the string with the machine, or inf if the string is not accepted. Arcs of the epsilon-free input projection are grouped once by label and destination; forward weights for a whole padded batch are then computed position by position with numpy reductions
+    """
+
+    def __init__(self, fst, semiring=None):
+        if semiring is None:
+            semiring = fst.weight_type()
+        if semiring not in ('tropical', 'log'):
+            raise ValueError(f'unsupported semiring {semiring}')
+        self.semiring = semiring
+        self.input_symbols = fst.input_symbols()
+
+        # Epsilon-free input projection in semiring
+        M = pynini.Fst.copy(fst)
+        if semiring == 'tropical' and M.arc_type() != 'standard':
+            M = pynini.arcmap(M, map_type='to_std')
+        elif semiring == 'log' and M.arc_type() != 'log':
+            M = pynini.arcmap(M, map_type='to_log')
+        M.project('input')
+        M.rmepsilon()
+        arrays = _from_native(M).to_arrays()
+        self.num_states = M.num_states()
+        self.start = M.start()
+
+        # Forward values are kept as log scores (negated weights)
+        self.final = -arrays['final'].astype(np.float64)
+
+        # Arcs of each label, sorted by destination: source states, scores,
+        # start of each destination segment, and destinations
+        label = arrays['ilabel']
+        order = np.lexsort((arrays['nextstate'], label))
+        label = label[order]
+        src = arrays['src'][order]
+        score = -arrays['weight'][order].astype(np.float64)
+        dest = arrays['nextstate'][order]
+        self._arcs = {}
+        bounds = np.flatnonzero(np.diff(label)) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(label)]):
+            if lo == hi:
+                continue
+            dest_x = dest[lo:hi]
+            starts = np.r_[0, np.flatnonzero(np.diff(dest_x)) + 1]
+            seg = np.cumsum(np.r_[0, np.diff(dest_x) != 0])
+            self._arcs[int(label[lo])] = (src[lo:hi], score[lo:hi], starts,
+                                          seg, dest_x[starts])
+
+    def _reduce(self, vals, starts, seg):
+        """
+        Semiring sum of log scores vals (strings x arcs) within each segment of arcs beginning at starts
+        """
+        vmax = np.maximum.reduceat(vals, starts, axis=1)
+        if self.semiring == 'tropical':
+            return vmax
+        vmax_ = np.where(np.isfinite(vmax), vmax, 0.0)
+        with np.errstate(divide='ignore'):
+            return np.log(
+                np.add.reduceat(np.exp(vals - vmax_[:, seg]), starts,
+                                axis=1)) + vmax_
+
+    def score_batch(self, X, lengths):
+        """
+        Scores (weights) of padded batch X (sequences x lengths.max() array of input ids), as float64 array
+        """
+        X = np.asarray(X, dtype=np.int64)
+        lengths = np.asarray(lengths)
+        m = X.shape[0]
+        if self.start < 0:
+            return np.full(m, np.inf)
+        alpha = np.full((m, self.num_states), -np.inf)
+        alpha[:, self.start] = 0.0
+        for i in range(X.shape[1]):
+            active = (i < lengths)
+            x_i = X[:, i]
+            # Sequences with the same symbol at position i
+            for x in np.unique(x_i[active]).tolist():
+                idx = np.flatnonzero(active & (x_i == x))
+                alpha_x = np.full((len(idx), self.num_states), -np.inf)
+                if x in self._arcs:
+                    src, score, starts, seg, dest = self._arcs[x]
+                    vals = alpha[idx][:, src] + score
+                    alpha_x[:, dest] = self._reduce(vals, starts, seg)
+                alpha[idx] = alpha_x
+
+        # Combine with final weights
+        vals = alpha + self.final
+        starts = np.zeros(1, dtype=np.int64)
+        seg = np.zeros(self.num_states, dtype=np.int64)
+        weights = -self._reduce(vals, starts, seg)[:, 0]
+        return weights + 0.0  # No negative zeros
+
+    def score_corpus(self, corpus):
+        """ Scores of strings in EncodedCorpus """
+        X, lengths = corpus.padded()
+        return self.score_batch(X, lengths)
+
+    def score(self, X):
+        """ Scores of space-separated strings X """
+        return self.score_corpus(EncodedCorpus.encode(X, self.input_symbols))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class TransduceServer():
+    """
+    Asyncio transduction service with micro-batching: concurrent requests are collected for up to max_delay seconds or max_batch inputs, transduced together by Fst.transduce_many in a worker thread, and resolved individually. Requests can be made in-process (await server.transduce(x)) or over a local socket (serve / request), one space-separated input per line
+    """
+
+    def __init__(self, fst, max_batch=64, max_delay=0.005, history=10000):
+        self.fst = fst
+        self.max_batch = max_batch
+        self.max_delay = max_delay  # Seconds
+        self.latencies = deque(maxlen=history)  # Seconds, recent requests
+        self.batch_sizes = deque(maxlen=history)
+        self._queue = None
+        self._batcher = None
+        self._executor = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._batcher = asyncio.ensure_future(self._run_batches(self._queue))
+        return self
+
+    async def stop(self):
+        """
+        Stop batching; requests in flight or still queued fail with RuntimeError
+        """
+        self._queue = None  # No new requests
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        # Wait for the current batch without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._executor.shutdown)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    async def transduce(self, x):
+        """ Outputs for space-separated input x (in-process client) """
+        if self._queue is None:
+            raise RuntimeError('TransduceServer is not running')
+        tic = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((x, future))
+        Y = await future
+        self.latencies.append(time.perf_counter() - tic)
+        return Y
+
+    async def _run_batches(self, queue):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                # Wait for first request, then collect more until deadline
+                batch = [await queue.get()]
+                deadline = loop.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(
+                            queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                X = [x for (x, future) in batch]
+                try:
+                    Y = await loop.run_in_executor(self._executor,
+                                                   self.fst.transduce_many,
+                                                   X)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    for (x, future) in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    batch = []
+                    continue
+                self.batch_sizes.append(len(batch))
+                for (x, future), Y_x in zip(batch, Y):
+                    if not future.done():
+                        future.set_result(Y_x)
+                batch = []
+        except asyncio.CancelledError:
+            # Fail the batch in flight and all queued requests
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            for (x, future) in batch:
+                if not future.done():
+                    future.set_exception(
+                        RuntimeError('TransduceServer stopped'))
+            raise
+
+    def latency_percentiles(self, q=(50, 90, 99)):
+        """ Percentiles of recent request latencies (seconds) """
+        if len(self.latencies) == 0:
+            return {q_i: None for q_i in q}
+        vals = np.percentile(np.array(self.latencies), q)
+        return dict(zip(q, vals.tolist()))
+
+    # Socket interface
+
+    async def serve(self, host='127.0.0.1', port=0):
+        """
+        Start line-protocol server on local socket: each request line is an input, each response line is its tab-separated outputs (empty if the input has no outputs or its transduction failed); returns asyncio.Server (port from server.sockets[0].getsockname())
+        """
+        return await asyncio.start_server(self._handle, host, port)
+
+    async def _handle(self, reader, writer):
+
+        async def respond():
+            while True:
+                task = await pending_queue.get()
+                if task is None:
+                    break
+                try:
+                    Y = await task
+                except Exception:
+                    Y = []  # Failed request
+                writer.write(('\t'.join(Y) + '\n').encode('utf-8'))
+                await writer.drain()
+
+        # Requests on a connection are pipelined, responses sent in order
+        pending_queue = asyncio.Queue()
+        responder = asyncio.ensure_future(respond())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                x = line.decode('utf-8').rstrip('\n')
+                await pending_queue.put(
+                    asyncio.ensure_future(self.transduce(x)))
+            await pending_queue.put(None)
+            await responder
+        finally:
+            responder.cancel()
+            writer.close()
+
+
+async def request(X, host='127.0.0.1', port=None):
+    """
+    Send inputs X to TransduceServer over local socket, returning list of outputs for each input
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    for x in X:
+        writer.write((x + '\n').encode('utf-8'))
+    await writer.drain()
+    Y = []
+    for x in X:
+        line = (await reader.readline()).decode('utf-8').rstrip('\n')
+        Y.append(line.split('\t') if line != '' else [])
+    writer.close()
+    await writer.wait_closed()
+    return Y
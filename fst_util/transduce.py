@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Transduce a line-delimited corpus with a saved machine, streaming input in chunks and writing tab-separated (input, output) rows incrementally (one row per output; inputs without outputs get an empty output)
+
+usage: python -m fst_util.transduce machine.fst [input.txt] [-o output.tsv]
+"""
+
+import argparse
+import itertools
+import sys
+import time
+from .fst import read_fst
+
+
+def transduce_file(fst,
+                   infile,
+                   outfile,
+                   chunk_size=1000,
+                   workers=1,
+                   log=None):
+    """
+    Transduce lines of infile with fst, writing rows to outfile after each chunk; returns number of inputs processed
+    """
+    X = (line.rstrip('\n') for line in infile)
+    if workers > 1:
+        X, X_ = itertools.tee(X)  # Buffers only inputs in flight
+        pairs = zip(X, fst.transduce_parallel(X_, workers, chunk_size))
+    else:
+        pairs = _transduce_chunks(fst, X, chunk_size)
+
+    tic = time.perf_counter()
+    n = 0
+    while True:
+        chunk = list(itertools.islice(pairs, chunk_size))
+        if len(chunk) == 0:
+            break
+        rows = []
+        for x, Y in chunk:
+            if len(Y) == 0:
+                rows.append(f'{x}\t\n')
+            for y in Y:
+                rows.append(f'{x}\t{y}\n')
+        outfile.writelines(rows)
+        outfile.flush()
+        n += len(chunk)
+        if log is not None:
+            elapsed = time.perf_counter() - tic
+            print(f'{n} inputs, {elapsed:.1f}s, {n / elapsed:.0f} inputs/s',
+                  file=log)
+    return n
+
+
+def _transduce_chunks(fst, X, chunk_size):
+    """ Generate (input, outputs) pairs, transducing chunks of X in batch """
+    while True:
+        chunk = list(itertools.islice(X, chunk_size))
+        if len(chunk) == 0:
+            break
+        yield from zip(chunk, fst.transduce_many(chunk))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m fst_util.transduce',
+        description='Transduce line-delimited input with a saved machine')
+    parser.add_argument('machine', help='machine written by Fst.write()')
+    parser.add_argument(
+        'input', nargs='?', default='-', help='input file (default: stdin)')
+    parser.add_argument(
+        '-o', '--output', default='-', help='output file (default: stdout)')
+    parser.add_argument(
+        '--chunk-size', type=int, default=1000, help='inputs per chunk')
+    parser.add_argument(
+        '--workers', type=int, default=1, help='worker processes')
+    parser.add_argument(
+        '-q', '--quiet', action='store_true', help='no throughput report')
+    args = parser.parse_args(argv)
+
+    fst = read_fst(args.machine)
+    infile = sys.stdin if args.input == '-' else \
+        open(args.input, encoding='utf-8')
+    outfile = sys.stdout if args.output == '-' else \
+        open(args.output, 'w', encoding='utf-8')
+    log = None if args.quiet else sys.stderr
+    try:
+        transduce_file(fst, infile, outfile, args.chunk_size, args.workers,
+                       log)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path.home() / 'Code/Python/fst_util'))
+from fst_util import config as fst_config
+from fst_util.fst import *
+
+
+def compose_all_pairs(fst1, fst2):
+    """ Reference composition that compares all pairs of arcs """
+    fst = Fst(fst_config.symtable)
+    Zero = pynini.Weight.zero(fst.weight_type())
+    q0 = (fst1.start(), fst2.start())
+    fst.add_state(q0)
+    fst.set_start(q0)
+    Q = set([q0])
+    Q_new = [q0]
+    while len(Q_new) != 0:
+        src = Q_new.pop()
+        src1, src2 = src
+        for t1 in fst1.arcs(src1):
+            for t2 in fst2.arcs(src2):
+                if t1.olabel != t2.ilabel:
+                    continue
+                dest = (t1.nextstate, t2.nextstate)
+                fst.add_state(dest)
+                fst.add_arc(
+                    src=src, ilabel=t1.ilabel, olabel=t2.olabel, dest=dest)
+                if fst1.final(dest[0]) != Zero and fst2.final(dest[1]) != Zero:
+                    fst.set_final(dest)
+                if dest not in Q:
+                    Q.add(dest)
+                    Q_new.append(dest)
+    return fst
+
+
+def bench(sizes=(4, 8, 16, 32, 64), context_length=1):
+    """
+    Time composition of left and right context acceptors as the alphabet grows
+    """
+    print('|Sigma|\tstates\tarcs\tall-pairs (s)\tindexed (s)')
+    for n in sizes:
+        config = {'sigma': [f'x{i}' for i in range(n)]}
+        fst_config.init(config)
+        L = left_context_acceptor(context_length=context_length)
+        R = right_context_acceptor(context_length=context_length)
+
+        tic = time.perf_counter()
+        M0 = compose_all_pairs(L, R)
+        t0 = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        M1 = compose(L, R)
+        t1 = time.perf_counter() - tic
+
+        assert M1.num_states() <= M0.num_states()
+        print(f'{n}\t{M1.num_states()}\t{M1.num_arcs()}\t'
+              f'{t0:.3f}\t{t1:.3f}')
+
+
+def bench_native(context_lengths=(1, 2, 3), sigma=('a', 'b', 'c', 'd')):
+    """
+    Time Python and native (pynini) composition of left and right context acceptors
+    """
+    print('k\tstates\tarcs\tpython (s)\tnative (s)')
+    config = {'sigma': list(sigma)}
+    fst_config.init(config)
+    for k in context_lengths:
+        L = left_context_acceptor(context_length=k)
+        R = right_context_acceptor(context_length=k)
+
+        tic = time.perf_counter()
+        M0 = compose(L, R)
+        t0 = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        M1 = compose(L, R, native=True)
+        t1 = time.perf_counter() - tic
+
+        assert M0.num_states() == M1.num_states()
+        assert set(M0._label2state) == set(M1._label2state)
+        assert _labeled_arcs(M0) == _labeled_arcs(M1)
+        print(f'{k}\t{M1.num_states()}\t{M1.num_arcs()}\t'
+              f'{t0:.3f}\t{t1:.3f}')
+
+
+def _labeled_arcs(M):
+    """ Arcs and final weights of M keyed by state labels """
+    arcs = set()
+    for q in M.states():
+        arcs.add((M.state_label(q), str(M.final(q))))
+        for t in M.arcs(q):
+            arcs.add((M.state_label(q), t.ilabel, t.olabel, str(t.weight),
+                      M.state_label(t.nextstate)))
+    return arcs
+
+
+if __name__ == '__main__':
+    bench()
+    bench_native()
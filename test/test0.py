@@ -38,6 +38,18 @@ def test():
     # Accepted strings
     print(accepted_strings(L, 'input', 4))
 
+    # Counts of accepted strings by length
+    counts = count_accepted(L, 'input', 4, deterministic=True)
+    print(counts)
+    assert counts.sum() == len(accepted_strings(L, 'input', 4))
+
+    # Array export / import (state labels preserved)
+    arrays = L.to_arrays()
+    print(arrays['src'], arrays['ilabel'], arrays['nextstate'])
+    L2 = L.from_arrays(arrays)
+    assert accepted_strings(L2, 'input', 4) == accepted_strings(L, 'input', 4)
+    assert L2._state2label == L._state2label
+
     # Connect (state labels preserved)
     C = Fst(fst_config.symtable)
     qf = C.add_state('0')
@@ -52,6 +64,11 @@ def test():
     C_trim = C.connect()
     print(C_trim._state2label)
     C_trim.draw('C_trim.dot')
+    C_inplace = C.copy().connect(inplace=True)
+    assert C_inplace._state2label == C_trim._state2label
+    assert C_inplace._label2state == C_trim._label2state
+    C_del = C.copy().delete_states({q}, inplace=True)
+    assert C_del._state2label == C.delete_states({q})._state2label
 
     # Composition
     config = {'sigma': ['a', 'b']}
@@ -77,6 +94,56 @@ def test():
     M = compose(M1, M2)
     M.draw('M.dot')
 
+    # Native composition of weighted machines matches compose()
+    def labeled_arcs(M):
+        return {(M.state_label(q), str(M.final(q)), t.ilabel, t.olabel,
+                 str(t.weight), M.state_label(t.nextstate))
+                for q in M.states() for t in M.arcs(q)}
+
+    W1 = Fst(fst_config.symtable)
+    for q in [0, 1]:
+        W1.add_state(q)
+    W1.set_start(0)
+    W1.set_final(1, 2.0)
+    for x in fst_config.sigma:
+        W1.add_arc(src=0, ilabel=x, weight=1.5, dest=1)
+    W = compose(W1, M2)
+    W_native = compose(W1, M2, native=True)
+    assert labeled_arcs(W) == labeled_arcs(W_native)
+
+    # Composition cascade (flat state labels)
+    M = compose_many([M1, M2, M1])
+    print(M._state2label)
+
+    # Construction budgets (for L1, crossed by the last state expansion)
+    L1 = Fst(fst_config.symtable)
+    L1.add_state(0)
+    L1.set_start(0)
+    L1.set_final(0)
+    L1.add_arcs([(0, 'a', 'a', None, 0)] * 10)
+    budgets = [
+        (lambda: compose(L1, L1, max_arcs=2), 'max_arcs'),
+        (lambda: compose_many([L1, L1, L1], max_arcs=2), 'max_arcs'),
+        (lambda: left_context_acceptor(3, max_states=10), 'max_states'),
+        (lambda: right_context_acceptor(3, max_arcs=10), 'max_arcs'),
+        (lambda: compose(M1, M2, max_states=2), 'max_states'),
+        (lambda: compose(M1, M2, native=True, max_arcs=2), 'max_arcs'),
+        (lambda: compose_many([M1, M2, M1], timeout=0), 'timeout'),
+    ]
+    for (build, limit) in budgets:
+        try:
+            build()
+            assert False
+        except FstBudgetError as e:
+            print(e)
+            assert e.limit == limit
+            if limit == 'max_states':
+                assert e.num_states > e.value
+            elif limit == 'max_arcs':
+                assert e.num_arcs > e.value
+            else:
+                assert e.value == 0 and e.elapsed > 0
+
     # Arc deletion
     config = {'sigma': ['a', 'b']}
     fst_config.init(config)
@@ -89,6 +156,27 @@ def test():
     fst.add_arc(src=0, ilabel='b', dest=1)
     print(fst.print())
 
+    # Delete one of two parallel weighted arcs (labeled source state)
+    W = Fst(fst_config.symtable)
+    for q in ['q0', 'q1']:
+        W.add_state(q)
+    W.set_start('q0')
+    W.set_final('q1')
+    W.add_arc(src='q0', ilabel='a', weight=1.0, dest='q1')
+    W.add_arc(src='q0', ilabel='a', weight=2.0, dest='q1')
+    W.add_arc(src='q0', ilabel='b', dest='q1')
+    dead = [t for t in W.arcs('q0') if float(t.weight) == 2.0]
+    W.delete_arcs([('q0', t) for t in dead])
+    live = [(W.input_label(t.ilabel), float(t.weight),
+             W.state_label(t.nextstate)) for t in W.arcs('q0')]
+    print(live)
+    assert live == [('a', 1.0, 'q1'), ('b', 0.0, 'q1')]
+
+    # Bulk arc insertion
+    fst.add_arcs([(1, 'a', None, None, 1), (1, 'b', 'a', 0.5, 0)])
+    fst.add_arcs(src=[0, 0], ilabel=['a', 'b'], olabel=['b', 'a'], dest=[0, 0])
+    print(fst.print())
+
 
 if __name__ == '__main__':
     test()
\ No newline at end of file
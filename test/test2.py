@@ -1,9 +1,11 @@
 import sys
+import numpy as np
 from pathlib import Path
 
 sys.path.append(str(Path.home() / 'Code/Python/fst_util'))
 from fst_util import config as fst_config
 from fst_util.fst import *
+from fst_util.scorer import ForwardScorer
 
 
 def test():
@@ -16,6 +18,19 @@ def test():
     M = M.map_weights(map_type='to_log')
     print(M.print(acceptor=True, show_weight_one=True))
 
+    # Best outputs with weights
+    Y = M.transduce_nbest('⋊ a b ⋉', k=2)
+    print(Y)
+    assert [y for (y, w) in Y] == ['⋊ a b ⋉']
+    assert M.transduce_nbest('a b', k=2) == []
+
+    # Batch scoring (path sums)
+    X = ['⋊ a b ⋉', '⋊ ⋉', 'a b', '⋊ c c a ⋉']
+    scores = ForwardScorer(M).score(X)
+    print(scores)
+    assert list(scores == np.inf) == [False, False, True, False]
+    assert scores[0] == M.transduce_nbest('⋊ a b ⋉')[0][1]
+
     M = pynini.push(M, push_weights=True)
     print(M.print(acceptor=True, show_weight_one=True))
 
@@ -0,0 +1,239 @@
+import asyncio
+import sys
+import tempfile
+import time
+import numpy as np
+from pathlib import Path
+
+sys.path.append(str(Path.home() / 'Code/Python/fst_util'))
+from fst_util import config as fst_config
+from fst_util.fst import *
+from fst_util.lazy_fst import *
+from fst_util.corpus import EncodedCorpus
+from fst_util.sampler import StringSampler
+from fst_util.server import TransduceServer, request
+from fst_util import transduce as transduce_cli
+
+
+def test():
+    # Lazy composition of left- and right- context acceptors
+    config = {'sigma': ['a', 'b', 'c']}
+    fst_config.init(config)
+    L = left_context_acceptor(context_length=2)
+    R = right_context_acceptor(context_length=1)
+    M = compose(L, R)
+    M_lazy = LazyComposeFst(L, R, cache_size=8)
+    for x in ['⋊ a b ⋉', '⋊ c c a ⋉', '⋊ ⋉', 'a b']:
+        Y = M.transduce(x)
+        Y_lazy = M_lazy.transduce(x)
+        print(x, '->', Y_lazy)
+        assert sorted(set(Y)) == sorted(Y_lazy)
+    assert len(M_lazy._cache) <= 8
+
+    # Batched transduction
+    X = ['⋊ a b ⋉', '⋊ c c a ⋉', '⋊ ⋉', 'a b', '⋊ a b ⋉']
+    Y = M.transduce_many(X)
+    print(Y)
+    assert Y == [M.transduce(x) for x in X]
+
+    # Transduction of symbol ids
+    symtable = fst_config.symtable
+    for x, Y_x in zip(X, Y):
+        x_ids = [symtable.find(sym) for sym in x.split()]
+        Y_ids = M.transduce_ids(x_ids)
+        assert [' '.join([symtable.find(y) for y in y_ids])
+                for y_ids in Y_ids] == Y_x
+
+    # Encoded corpus
+    corpus = EncodedCorpus.encode(X)
+    assert corpus.decode() == X
+    assert [M.transduce_ids(x_ids) for x_ids in corpus] == \
+        [M.transduce_ids([symtable.find(sym) for sym in x.split()])
+         for x in X]
+
+    # Parallel transduction
+    assert list(M.transduce_parallel(X, workers=2, chunk_size=2)) == Y
+    Y_par = dict(M.transduce_parallel(X, workers=2, chunk_size=2,
+                                      ordered=False))
+    assert [Y_par[i] for i in range(len(X))] == Y
+
+    # Corpus transduction from the command line (in-process and workers)
+    rows = [f'{x}\t{y}\n' for x, Y_x in zip(X, Y) for y in (Y_x or [''])]
+    with tempfile.TemporaryDirectory() as tmp:
+        M.write(f'{tmp}/M.fst')
+        with open(f'{tmp}/in.txt', 'w', encoding='utf-8') as f:
+            f.writelines(x + '\n' for x in X)
+        for workers in ['1', '2']:
+            transduce_cli.main([
+                f'{tmp}/M.fst', f'{tmp}/in.txt', '-o', f'{tmp}/out.tsv', '-q',
+                '--chunk-size', '2', '--workers', workers
+            ])
+            with open(f'{tmp}/out.tsv', encoding='utf-8') as f:
+                assert f.readlines() == rows
+
+    # Micro-batching server (in-process and socket clients)
+    async def serve():
+        async with TransduceServer(M, max_batch=4) as server:
+            Y_server = await asyncio.gather(*[server.transduce(x) for x in X])
+            assert list(Y_server) == Y
+            socket_server = await server.serve()
+            port = socket_server.sockets[0].getsockname()[1]
+            assert await request(X, port=port) == Y
+            socket_server.close()
+            print(server.latency_percentiles())
+
+    # Failed batches give empty responses over the socket
+    class FailingFst():
+
+        def transduce_many(self, X):
+            raise ValueError('transduction failed')
+
+    async def serve_failing():
+        async with TransduceServer(FailingFst()) as server:
+            socket_server = await server.serve()
+            port = socket_server.sockets[0].getsockname()[1]
+            Y_failed = await asyncio.wait_for(request(X[:2], port=port), 5)
+            assert Y_failed == [[], []]
+            socket_server.close()
+
+    # Stopping fails requests in flight and queued; no requests after stop
+    class SlowFst():
+
+        def transduce_many(self, X):
+            time.sleep(0.2)
+            return [[x] for x in X]
+
+    async def serve_stopped():
+        server = TransduceServer(SlowFst(), max_batch=1)
+        try:
+            await server.transduce('a')
+        except RuntimeError as e:
+            print(e)
+        await server.start()
+        tasks = [asyncio.ensure_future(server.transduce(x)) for x in X[:3]]
+        await asyncio.sleep(0.05)
+        await server.stop()
+        results = await asyncio.wait_for(
+            asyncio.gather(*tasks, return_exceptions=True), 5)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        try:
+            await server.transduce('a')
+            assert False
+        except RuntimeError as e:
+            print(e)
+
+    asyncio.run(serve())
+    asyncio.run(serve_failing())
+    asyncio.run(serve_stopped())
+
+    # Cached transduction, invalidated by mutation
+    M.set_transduce_cache(maxsize=4)
+    for x in X:
+        assert M.transduce(x) == Y[X.index(x)]
+    print(M.transduce_cache_info())
+    assert M.transduce_cache_info()['hits'] == 1
+    M.add_state()
+    assert M.transduce_cache_info()['currsize'] == 0
+    M.set_transduce_cache(None)
+
+    # Transduction after in-place pynini operation
+    T = Fst(fst_config.symtable)
+    T.add_state(0)
+    T.add_state(1)
+    T.set_start(0)
+    T.set_final(1)
+    T.add_arc(0, 'a', 'b', None, 1)
+    assert T.transduce('a') == ['b']
+    T.invert()
+    assert T.transduce('b') == ['a']
+    assert T.transduce_many(['b', 'a']) == [['a'], []]
+
+    # Cache cleared by arcs written through mutable iterator
+    T.set_transduce_cache(maxsize=4)
+    aiter = T.mutable_arcs(0)
+    assert T.transduce('b') == ['a']
+    t = aiter.value()
+    t.olabel = fst_config.symtable.find('c')
+    aiter.set_value(t)
+    assert T.transduce('b') == ['c']
+    T.set_transduce_cache(None)
+
+    # Compiled runtime for deterministic machine
+    D = L.compile_deterministic()
+    for x in X:
+        assert D.transduce(x) == L.transduce(x)
+    try:
+        M.compile_deterministic()
+    except ValueError as e:
+        print(e)
+
+    # Cascade with lazy operand
+    M2 = LazyComposeFst(M_lazy, left_context_acceptor(context_length=1))
+    q = M2.start()
+    print(M2.state_label(q))
+    print(M2.transduce('⋊ a b ⋉'))
+
+    # Path enumeration
+    X = set([x for (x, y) in M_lazy.paths(max_len=4)])
+    print(X)
+    assert X == set(accepted_strings(M, 'input', 2))
+
+    # Streaming accepted strings (in order of length, epsilons skipped)
+    X = list(iter_accepted_strings(M, 'input', 2))
+    assert len(X) == len(set(X))
+    assert [len(x.split()) for x in X] == sorted([len(x.split()) for x in X])
+    E = Fst(M.input_symbols())
+    for q in range(3):
+        E.add_state(q)
+    E.set_start(0)
+    E.set_final(2)
+    E.add_arc(0, 'a', None, None, 1)
+    E.add_arc(1, 0, 0, None, 0)
+    E.add_arc(1, 'b', None, None, 2)
+    print(list(iter_accepted_strings(E, 'input', 1)))
+    assert set(iter_accepted_strings(E, 'input', 1)) == \
+        {'a b', 'a a b'}
+
+    # Bounded path enumeration on cyclic machine
+    X = list(E.istrings(max_len=3, limit=10))
+    print(X)
+    assert X == list(iter_accepted_strings(E, 'input', 1))
+    assert set(E.istrings(max_len=3, limit=10, order='weight')) == set(X)
+    assert len(list(E.istrings(max_len=3, unique=False))) == len(X)
+    X = [x.split() for x in L.istrings(max_len=4, unique=False)]
+    assert [len(x) for x in X] == sorted([len(x) for x in X])
+    for kwargs in [{'order': 'bogus'}, {'order': 'weight'}]:
+        try:
+            E.istrings(**kwargs)  # Checked before iteration
+            assert False
+        except ValueError as e:
+            print(e)
+
+    # Uniform sampling of accepted strings
+    S = StringSampler(M, 'input', max_len=2, seed=0)
+    X = S.sample(10)
+    print(X)
+    assert set(X) <= accepted_strings(M, 'input', 2)
+    X_ids, lengths = S.sample_ids(1000)
+    assert np.all(lengths >= 2)
+    assert np.all(X_ids[:, 0] == fst_config.symtable.find(fst_config.bos))
+
+    # Weighted sampling sums converging epsilon paths (tropical machine)
+    W = Fst(fst_config.symtable)
+    for q in range(4):
+        W.add_state(q)
+    W.set_start(0)
+    W.set_final(3)
+    W.add_arc(0, 0, 0, None, 1)
+    W.add_arc(0, 0, 0, None, 2)
+    W.add_arc(1, 'a', 'a', None, 3)
+    W.add_arc(2, 'a', 'a', None, 3)
+    W.add_arc(0, 'b', 'b', None, 3)
+    S = StringSampler(W, max_len=0, weighted=True, seed=0)
+    X = S.sample(6000)
+    print(X.count('a') / len(X))
+    assert abs(X.count('a') / len(X) - 2 / 3) < 0.03
+
+
+if __name__ == '__main__':
+    test()